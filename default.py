@@ -5,6 +5,18 @@ import re
 import uuid
 import os
 import shutil
+import hashlib
+import json
+import functools
+import fnmatch
+import mmap
+import struct
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from threading import Timer
 
 #DEFAULT_LOG_LEVEL = logging.DEBUG
@@ -15,15 +27,60 @@ PLUGIN_KEY = 'ScopedQuickSelect'
 
 ARG_NAME_TARGET_SCOPE = 'scope'
 
+ARG_NAME_REPLACEMENT = 'replacement'
+
 SCOPE_MARKERS_KEY = PLUGIN_KEY + 'scope_markers'
 
-# TODO: If we made these "immutable" and/or kept copies of these
-# per "edit" we could check the command_history and roll-back
-# the whole state instead of trying to re-create it?
+SCOPE_MATCHES_KEY = PLUGIN_KEY + 'scope_matches'
+
+MATCH_COUNT_STATUS_KEY = PLUGIN_KEY + 'match_count'
+
+# View setting that makes ScopedQuickSelectViewListener apply to a view,
+# so that views we have no state for don't pay for our event handlers
+ACTIVE_VIEW_SETTING = 'scoped_quick_select_active'
+
+# View setting that makes ScopedQuickSelectRecorder apply to a view
+RECORDING_VIEW_SETTING = 'scoped_quick_select_recording'
+
+# The TraceRecorder of the current recording (if any)
+TRACE_RECORDER = None
+
+# view id -> generation of the most recently requested match highlight
+MATCH_HIGHLIGHT_GENERATIONS = {}
+
 VIEW_DATA = {}
 
+# view id -> OrderedDict of (change count, selection hash) -> IncrementalSnapshot
+INCREMENTAL_SNAPSHOTS = {}
+
+MAX_INCREMENTAL_SNAPSHOTS_PER_VIEW = 1000
+
+RESULTS_PANEL_NAME = 'scoped_quick_select'
+
+# Files searched by each task of scoped_find_across_views(), so a big
+# project doesn't queue a callback on the main thread for every file
+FILES_PER_SEARCH_TASK = 64
+
+# Shared by anything that wants to do work off of the main/async threads
+WORKER_POOL = None
+
+# Only the most recent cross view search gets to write to the results panel
+CROSS_VIEW_SEARCH_GENERATION = 0
+
+# Scopes whose next levels are worth computing ahead of time, because
+# they're usually expanded by tapping the same key repeatedly
+PREFETCH_TARGET_SCOPES = set(['parentheses', 'curly braces', 'block'])
+
+# name -> count, for keeping an eye on how things are behaving in practice
+PERF_COUNTERS = {}
+
+# Mirror of the `highlight_matches_in_scope` setting, kept up to date by
+# plugin_settings_changed(), so selection changes don't have to read it
+HIGHLIGHT_MATCHES_IN_SCOPE = False
+
 TEMP_VIEWS_SHOWING = set()
 
+# NOTE: Treated as immutable, because they are shared between snapshots
 class IncrementalMatch:
 	__slots__ = ["selected", "region"]
 
@@ -31,6 +88,69 @@ class IncrementalMatch:
 		self.selected = selected
 		self.region = region
 
+class VisitedMatches:
+	"""Persistent stack of IncrementalMatch. push() and pop() return a new
+	   stack that shares the rest of its entries with this one."""
+	__slots__ = ["top", "rest", "bottom", "length"]
+
+	def __init__(self, top=None, rest=None):
+		self.top = top
+		self.rest = rest
+		if rest is None:
+			self.bottom = top
+			self.length = 0 if top is None else 1
+		else:
+			self.bottom = rest.bottom if rest.length else top
+			self.length = rest.length + 1
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		node = self
+		while node.length:
+			yield node.top
+			node = node.rest
+
+	def push(self, match):
+		return VisitedMatches(match, self)
+
+	def pop(self):
+		return self.rest
+
+NO_VISITED_MATCHES = VisitedMatches()
+
+class IncrementalSnapshot:
+	__slots__ = [
+		"original_cursor_location",
+		"visited_matches",
+		"wrapped",
+		"pattern",
+	]
+
+	def __init__(self, view_data):
+		self.original_cursor_location = view_data.original_cursor_location
+		self.visited_matches = view_data.visited_matches
+		self.wrapped = view_data.wrapped
+		self.pattern = view_data.pattern
+
+class SelectionPage:
+	"""Where scoped_quick_select() stopped selecting, once it hit `max_selections`"""
+	__slots__ = [
+		"change_count",
+		"pattern",
+		"scope_region",
+		"resume_position",
+		"remaining",
+	]
+
+	def __init__(self, change_count, pattern, scope_region):
+		self.change_count = change_count
+		self.pattern = pattern
+		self.scope_region = scope_region
+		self.resume_position = scope_region.begin()
+		self.remaining = 0
+
 class LayoutInfo:
 	__slots__ = [
 		"tabs_visible",
@@ -57,22 +177,39 @@ class ViewData:
 		"start_clone",
 		"end_clone",
 		"timer",
+		"snapshot_key",
+		"prefetched_scopes",
+		"selection_page",
 	]
 
 	def __init__(self):
 		self.original_cursor_location = None
-		self.visited_matches = []
+		self.visited_matches = NO_VISITED_MATCHES
 		self.wrapped = False
 		self.pattern = None
 		self.original_layout_info = None
 		self.start_clone = None
 		self.end_clone = None
 		self.timer = None
+		self.snapshot_key = None
+		# (change count, target scope, selection, repeat count) -> Region
+		self.prefetched_scopes = {}
+		self.selection_page = None
+
+	def restore(self, snapshot):
+		self.original_cursor_location = snapshot.original_cursor_location
+		self.visited_matches = snapshot.visited_matches
+		self.wrapped = snapshot.wrapped
+		self.pattern = snapshot.pattern
 
 class ScopedQuickSelect(sublime_plugin.TextCommand):
 	def run(self, edit, **args):
 		scoped_quick_select(self, self.view, edit, args[ARG_NAME_TARGET_SCOPE])
 
+class ScopedQuickSelectNextPage(sublime_plugin.TextCommand):
+	def run(self, edit, **args):
+		scoped_quick_select_next_page(self, self.view, edit)
+
 class SetQuickSelectScope(sublime_plugin.TextCommand):
 	def run(self, edit, **args):
 		token = edit.edit_token
@@ -98,6 +235,51 @@ class IncrementalQuickSelect(sublime_plugin.TextCommand):
 	def run(self, edit, **args):
 		incremental_quick_select(self, self.view, edit, args["add"].casefold() == "True".casefold())
 
+class ScopedReplace(sublime_plugin.TextCommand):
+	def run(self, edit, replacement, **args):
+		target_scope = args.get(ARG_NAME_TARGET_SCOPE, 'current_marked_scope')
+		scoped_replace(self, self.view, edit, target_scope, replacement)
+
+	def input(self, args):
+		if ARG_NAME_REPLACEMENT not in args:
+			return ReplacementInputHandler(self.view)
+		return None
+
+class ReplacementInputHandler(sublime_plugin.TextInputHandler):
+	def __init__(self, view):
+		self.view = view
+
+	def name(self):
+		return ARG_NAME_REPLACEMENT
+
+	def placeholder(self):
+		return 'Replacement'
+
+	def initial_text(self):
+		selection = self.view.sel()[0]
+		if selection.empty():
+			selection = self.view.word(selection)
+		return self.view.substr(selection)
+
+class ScopedFindAcrossViews(sublime_plugin.WindowCommand):
+	def run(self, **args):
+		scoped_find_across_views(self, self.window,
+		                         args.get(ARG_NAME_TARGET_SCOPE, 'current_marked_scope'),
+		                         args.get('files'),
+		                         args.get('project', False))
+
+class ShowQuickSelectStats(sublime_plugin.WindowCommand):
+	def run(self, **args):
+		show_quick_select_stats(self, self.window)
+
+class StartQuickSelectRecording(sublime_plugin.TextCommand):
+	def run(self, edit, **args):
+		start_quick_select_recording(self, self.view, args.get('path'))
+
+class StopQuickSelectRecording(sublime_plugin.WindowCommand):
+	def run(self, **args):
+		stop_quick_select_recording(self, self.window)
+
 class DismissScopePreview(sublime_plugin.TextCommand):
 	def run(self, eidt, **args):
 		view = self.view
@@ -115,34 +297,808 @@ def has_comment_scope(scopes):
 def has_string_scope(scopes):
 	return any(scope.split('.')[0] == "string" for scope in scopes.split(' '))
 
-def get_quick_select_scope(view, first_sel, target_scope, repeat_count):
+# Fallback lexer for syntaxes that don't give us usable comment/string/block
+# scopes (e.g. plain text, or syntaxes without meta markup). It only knows
+# enough about each language to skip over comments and strings, and pairs up
+# the delimiters in a single pass over the text so that scope lookups don't
+# need any per-character API calls.
+
+MASK_CODE = 0
+MASK_COMMENT = 1
+MASK_STRING = 2
+
+LEXER_DELIMITERS = [('(', ')'), ('{', '}'), ('[', ']'), ('<', '>')]
+
+class LexerRules:
+	__slots__ = [
+		"line_comments",
+		"block_comments",
+		"strings",
+		"escape",
+		"indented_blocks",
+		"_token_re",
+		"_string_end_res",
+	]
+
+	def __init__(self, line_comments=(), block_comments=(), strings=(), escape='\\', indented_blocks=False):
+		self.line_comments = list(line_comments)
+		# (open, close)
+		self.block_comments = list(block_comments)
+		# (open, close, multiline)
+		self.strings = list(strings)
+		self.escape = escape
+		# Whether blocks are delimited by indentation rather than braces
+		self.indented_blocks = indented_blocks
+		self._token_re = None
+		self._string_end_res = None
+
+	def token_re(self):
+		if self._token_re is None:
+			tokens = set(self.line_comments)
+			tokens.update(open_token for (open_token, _) in self.block_comments)
+			tokens.update(open_token for (open_token, _, _) in self.strings)
+			for (open_delim, close_delim) in LEXER_DELIMITERS:
+				tokens.add(open_delim)
+				tokens.add(close_delim)
+
+			# NOTE: Longest first, so e.g. `"""` wins over `"` and `--[[` over `--`
+			ordered = sorted(tokens, key=len, reverse=True)
+			self._token_re = re.compile('|'.join(re.escape(t) for t in ordered))
+
+		return self._token_re
+
+	def string_end_re(self, open_token):
+		if self._string_end_res is None:
+			self._string_end_res = {}
+			for (string_open, string_close, multiline) in self.strings:
+				alternatives = []
+				if self.escape:
+					alternatives.append(re.escape(self.escape) + '.')
+				alternatives.append(re.escape(string_close))
+				if not multiline:
+					alternatives.append('\n')
+				self._string_end_res[string_open] = (
+					re.compile('|'.join(alternatives), re.DOTALL), string_close)
+
+		return self._string_end_res[open_token]
+
+C_LIKE_LEXER_RULES = LexerRules(
+	line_comments=['//'],
+	block_comments=[('/*', '*/')],
+	strings=[('"', '"', False), ("'", "'", False)])
+
+# Keyed by the name of the syntax file (without extension)
+LEXER_RULES = {
+	'C': C_LIKE_LEXER_RULES,
+	'C++': C_LIKE_LEXER_RULES,
+	'C#': C_LIKE_LEXER_RULES,
+	'Objective-C': C_LIKE_LEXER_RULES,
+	'Java': C_LIKE_LEXER_RULES,
+	'Kotlin': C_LIKE_LEXER_RULES,
+	'Scala': C_LIKE_LEXER_RULES,
+	'Swift': C_LIKE_LEXER_RULES,
+	'Dart': C_LIKE_LEXER_RULES,
+	'JavaScript': LexerRules(
+		line_comments=['//'],
+		block_comments=[('/*', '*/')],
+		strings=[('"', '"', False), ("'", "'", False), ('`', '`', True)]),
+	'TypeScript': LexerRules(
+		line_comments=['//'],
+		block_comments=[('/*', '*/')],
+		strings=[('"', '"', False), ("'", "'", False), ('`', '`', True)]),
+	'Go': LexerRules(
+		line_comments=['//'],
+		block_comments=[('/*', '*/')],
+		strings=[('"', '"', False), ("'", "'", False), ('`', '`', True)]),
+	# NOTE: No single quotes, they are far more likely to be lifetimes
+	'Rust': LexerRules(
+		line_comments=['//'],
+		block_comments=[('/*', '*/')],
+		strings=[('"', '"', True)]),
+	'PHP': LexerRules(
+		line_comments=['//', '#'],
+		block_comments=[('/*', '*/')],
+		strings=[('"', '"', True), ("'", "'", True)]),
+	'CSS': LexerRules(
+		block_comments=[('/*', '*/')],
+		strings=[('"', '"', False), ("'", "'", False)]),
+	'JSON': LexerRules(
+		strings=[('"', '"', False)]),
+	'Python': LexerRules(
+		line_comments=['#'],
+		strings=[('"""', '"""', True), ("'''", "'''", True),
+		         ('"', '"', False), ("'", "'", False)],
+		indented_blocks=True),
+	'Ruby': LexerRules(
+		line_comments=['#'],
+		strings=[('"', '"', True), ("'", "'", True)]),
+	'Bash': LexerRules(
+		line_comments=['#'],
+		strings=[('"', '"', True), ("'", "'", True)]),
+	'Lua': LexerRules(
+		line_comments=['--'],
+		block_comments=[('--[[', ']]')],
+		strings=[('"', '"', False), ("'", "'", False)]),
+	'SQL': LexerRules(
+		line_comments=['--'],
+		block_comments=[('/*', '*/')],
+		strings=[("'", "'", True)]),
+	'HTML': LexerRules(
+		block_comments=[('<!--', '-->')]),
+	'XML': LexerRules(
+		block_comments=[('<!--', '-->')]),
+}
+LEXER_RULES['Shell-Unix-Generic'] = LEXER_RULES['Bash']
+LEXER_RULES['JavaScript (Babel)'] = LEXER_RULES['JavaScript']
+
+# Used to pick the rules for plain text buffers (or unknown syntaxes)
+LEXER_RULES_BY_EXTENSION = {
+	'.c': 'C', '.h': 'C',
+	'.cc': 'C++', '.cpp': 'C++', '.cxx': 'C++', '.hh': 'C++', '.hpp': 'C++',
+	'.cs': 'C#',
+	'.m': 'Objective-C', '.mm': 'Objective-C',
+	'.java': 'Java', '.kt': 'Kotlin', '.scala': 'Scala', '.swift': 'Swift',
+	'.dart': 'Dart',
+	'.js': 'JavaScript', '.jsx': 'JavaScript', '.mjs': 'JavaScript',
+	'.ts': 'TypeScript', '.tsx': 'TypeScript',
+	'.go': 'Go', '.rs': 'Rust', '.php': 'PHP',
+	'.css': 'CSS', '.json': 'JSON',
+	'.py': 'Python', '.rb': 'Ruby', '.sh': 'Bash', '.bash': 'Bash',
+	'.lua': 'Lua', '.sql': 'SQL',
+	'.html': 'HTML', '.htm': 'HTML', '.xml': 'XML',
+}
+
+# Brackets only, we don't know what a comment or string looks like
+GENERIC_LEXER_RULES = LexerRules(escape=None)
+
+class DelimiterPairs:
+	"""Matched delimiters of a single kind, sorted by the open position.
+	   `parents` holds the index of the directly enclosing pair (or -1)"""
+	__slots__ = ["opens", "closes", "parents"]
+
+	def __init__(self, opens, closes, parents):
+		self.opens = opens
+		self.closes = closes
+		self.parents = parents
+
+	def find_enclosing(self, region, repeat_count, inclusive=False):
+		"""Returns (open, close) of the `repeat_count`th pair around
+		   `region`, or None if there aren't that many"""
+
+		# The pair with the closest open before the region is either the
+		# innermost pair around it, or nested inside of that pair.
+		if inclusive:
+			i = bisect_right(self.opens, region.begin()) - 1
+		else:
+			i = bisect_left(self.opens, region.begin()) - 1
+		while i >= 0 and self.closes[i] < region.end():
+			i = self.parents[i]
+
+		while i >= 0 and repeat_count > 0:
+			i = self.parents[i]
+			repeat_count -= 1
+
+		if i < 0:
+			return None
+
+		return (self.opens[i], self.closes[i])
+
+def make_delimiter_pairs(pairs):
+	# NOTE: Outer pairs first when they open at the same position (e.g. a
+	# class and its first method on the same line), so they're the parent
+	pairs.sort(key=lambda pair: (pair[0], -pair[1]))
+	opens = array(INDEX_TYPECODE, (open_pos for (open_pos, _) in pairs))
+	closes = array(INDEX_TYPECODE, (close_pos for (_, close_pos) in pairs))
+	parents = array(INDEX_TYPECODE, [-1]) * len(pairs)
+
+	enclosing = []
+	for (i, (open_pos, close_pos)) in enumerate(pairs):
+		while enclosing and closes[enclosing[-1]] < open_pos:
+			enclosing.pop()
+		if enclosing:
+			parents[i] = enclosing[-1]
+		enclosing.append(i)
+
+	return DelimiterPairs(opens, closes, parents)
+
+CLOSE_TO_OPEN_DELIMITER = dict((close_delim, open_delim) for (open_delim, close_delim) in LEXER_DELIMITERS)
+
+class DelimiterMatcher:
+	"""Pairs up the open and close delimiters of each kind, as they are
+	   found from the start of the text to the end"""
+	__slots__ = ["open_stacks", "pairs"]
+
+	def __init__(self):
+		self.open_stacks = dict((open_delim, []) for (open_delim, _) in LEXER_DELIMITERS)
+		self.pairs = dict((open_delim, []) for (open_delim, _) in LEXER_DELIMITERS)
+
+	def add(self, token, position):
+		"""Returns False if `token` isn't a delimiter"""
+		if token in self.open_stacks:
+			self.open_stacks[token].append(position)
+			return True
+
+		open_delim = CLOSE_TO_OPEN_DELIMITER.get(token)
+		if open_delim is None:
+			return False
+
+		stack = self.open_stacks[open_delim]
+		# NOTE: Unmatched close delimiters are just ignored
+		if stack:
+			self.pairs[open_delim].append((stack.pop(), position))
+		return True
+
+	def delimiter_pairs(self):
+		"""open delimiter -> DelimiterPairs"""
+		return dict((open_delim, make_delimiter_pairs(delimiter_pairs))
+		            for (open_delim, delimiter_pairs) in self.pairs.items())
+
+class StructuralIndex:
+	__slots__ = ["mask", "delimiters", "functions"]
+
+	def __init__(self, mask, delimiters, functions):
+		# One MASK_* byte per character
+		self.mask = mask
+		# open delimiter -> DelimiterPairs
+		self.delimiters = delimiters
+		# DelimiterPairs of (function begin, function end)
+		self.functions = functions
+
+def lex_text(text, rules):
+	text_len = len(text)
+	mask = bytearray(text_len)
+
+	line_comments = set(rules.line_comments)
+	block_comments = dict(rules.block_comments)
+	string_opens = set(open_token for (open_token, _, _) in rules.strings)
+	delimiter_matcher = DelimiterMatcher()
+
+	token_re = rules.token_re()
+	pos = 0
+	while True:
+		match = token_re.search(text, pos)
+		if match is None:
+			break
+
+		token = match.group()
+		start = match.start()
+		pos = match.end()
+
+		if delimiter_matcher.add(token, start):
+			continue
+
+		if token in line_comments:
+			end = text.find('\n', pos)
+			kind = MASK_COMMENT
+		elif token in block_comments:
+			end = text.find(block_comments[token], pos)
+			if end >= 0:
+				end += len(block_comments[token])
+			kind = MASK_COMMENT
+		elif token in string_opens:
+			(string_end_re, string_close) = rules.string_end_re(token)
+			end = -1
+			while True:
+				end_match = string_end_re.search(text, pos)
+				if end_match is None:
+					break
+				pos = end_match.end()
+				if end_match.group() == string_close:
+					end = pos
+					break
+				if end_match.group() == '\n':
+					# Unterminated single line string
+					end = end_match.start()
+					break
+			kind = MASK_STRING
+		else:
+			continue
+
+		if end < 0:
+			end = text_len
+
+		mask[start:end] = bytes([kind]) * (end - start)
+		pos = end
+
+	return StructuralIndex(mask, delimiter_matcher.delimiter_pairs(), make_delimiter_pairs([]))
+
+DELIMITER_RE = re.compile('|'.join(re.escape(delim) for pair in LEXER_DELIMITERS for delim in pair))
+
+def index_scoped_text(view, text):
+	"""Same as `lex_text()` but trusts the syntax's comment/string scopes"""
+	mask = bytearray(len(text))
+	for (selector, kind) in (('comment', MASK_COMMENT), ('string', MASK_STRING)):
+		for region in view.find_by_selector(selector):
+			mask[region.begin():region.end()] = bytes([kind]) * region.size()
+
+	delimiter_matcher = DelimiterMatcher()
+	for match in DELIMITER_RE.finditer(text):
+		start = match.start()
+		if mask[start] == MASK_CODE:
+			delimiter_matcher.add(match.group(), start)
+
+	functions = view.find_by_selector("meta.function") + view.find_by_selector("meta.methods")
+	function_pairs = [(r.begin(), r.end()) for r in functions]
+
+	return StructuralIndex(mask, delimiter_matcher.delimiter_pairs(), make_delimiter_pairs(function_pairs))
+
+def get_lexer_rules(view):
+	syntax = view.settings().get('syntax') or ''
+	syntax_name = os.path.splitext(os.path.basename(syntax))[0]
+	if syntax_name in LEXER_RULES:
+		return LEXER_RULES[syntax_name]
+
+	file_name = view.file_name()
+	if file_name:
+		extension = os.path.splitext(file_name)[1].lower()
+		if extension in LEXER_RULES_BY_EXTENSION:
+			return LEXER_RULES[LEXER_RULES_BY_EXTENSION[extension]]
+
+	return GENERIC_LEXER_RULES
+
+# Persisted indexes, for large files that get re-opened a lot.
+#
+# Layout (native byte order):
+#   header: magic, version, text length
+#   mask: one byte per character, padded to a multiple of 4
+#   for each delimiter in LEXER_DELIMITERS order, then the functions:
+#     count, opens[count], closes[count], parents[count]
+#
+# Everything is a flat array so that it can be used directly out of a
+# memory map without parsing it.
+
+INDEX_TYPECODE = 'i'
+INDEX_FILE_MAGIC = b'SQSI'
+INDEX_FILE_VERSION = 2
+INDEX_FILE_HEADER = struct.Struct('=4sII')
+INDEX_FILE_COUNT = struct.Struct('=I')
+INDEX_FILE_EXTENSION = '.idx'
+
+def get_index_cache_dir():
+	return os.path.join(sublime.cache_path(), PLUGIN_KEY, 'index')
+
+def get_index_cache_path(text, syntax):
+	content_hash = hashlib.sha1()
+	content_hash.update((syntax or '').encode('utf-8'))
+	content_hash.update(b'\0')
+	content_hash.update(text.encode('utf-8', 'surrogatepass'))
+	return os.path.join(get_index_cache_dir(), content_hash.hexdigest() + INDEX_FILE_EXTENSION)
+
+def should_persist_index(view):
+	return (get_setting('persist_index', False) and
+	        view.size() >= get_setting('persist_index_min_size', 1024 * 1024))
+
+def save_structural_index(path, index):
+	os.makedirs(os.path.dirname(path), exist_ok = True)
+
+	mask_len = len(index.mask)
+	all_pairs = [index.delimiters[open_delim] for (open_delim, _) in LEXER_DELIMITERS]
+	all_pairs.append(index.functions)
+
+	# NOTE: Write to a temp file first so a concurrent load never sees
+	# a partially written index
+	temp_path = path + '.' + uuid.uuid4().hex
+	with open(temp_path, 'wb') as f:
+		f.write(INDEX_FILE_HEADER.pack(INDEX_FILE_MAGIC, INDEX_FILE_VERSION, mask_len))
+		f.write(index.mask)
+		f.write(b'\0' * (-mask_len % 4))
+		for pairs in all_pairs:
+			f.write(INDEX_FILE_COUNT.pack(len(pairs.opens)))
+			for values in (pairs.opens, pairs.closes, pairs.parents):
+				f.write(values.tobytes())
+	os.replace(temp_path, path)
+
+	l_debug('saved index {path} ({size} bytes)', path=path, size=os.path.getsize(path))
+	evict_index_cache(get_setting('persist_index_budget_mb', 256) * 1024 * 1024)
+
+def load_structural_index(path):
+	"""The index saved at `path`, or None. Files that can't be used are
+	   deleted, and treated the same as not having been saved."""
+	try:
+		with open(path, 'rb') as f:
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except FileNotFoundError:
+		return None
+	except (OSError, ValueError):
+		# NOTE: e.g. an empty file, which can't be mapped
+		discard_index_file(path, None)
+		return None
+
+	try:
+		index = parse_structural_index(memoryview(mapped))
+	except (struct.error, ValueError, TypeError) as e:
+		l_debug('ignoring unreadable index {path}: {error}', path=path, error=e)
+		index = None
+
+	if index is None:
+		discard_index_file(path, mapped)
+		return None
+
+	# Keep recently used indexes from being evicted
+	os.utime(path, None)
+	return index
+
+def parse_structural_index(data):
+	"""Raises ValueError or struct.error if `data` isn't a complete index"""
+	def check_fits(offset, size):
+		if offset + size > len(data):
+			raise ValueError('truncated at {offset} of {size} bytes'.format(offset=offset, size=len(data)))
+
+	check_fits(0, INDEX_FILE_HEADER.size)
+	(magic, version, mask_len) = INDEX_FILE_HEADER.unpack_from(data, 0)
+	if magic != INDEX_FILE_MAGIC or version != INDEX_FILE_VERSION:
+		l_debug('ignoring incompatible index version {version}', version=version)
+		return None
+
+	offset = INDEX_FILE_HEADER.size
+	check_fits(offset, mask_len)
+	mask = data[offset:offset + mask_len]
+	offset += mask_len + (-mask_len % 4)
+
+	item_size = array(INDEX_TYPECODE).itemsize
+	all_pairs = []
+	for i in range(len(LEXER_DELIMITERS) + 1):
+		check_fits(offset, INDEX_FILE_COUNT.size)
+		(count,) = INDEX_FILE_COUNT.unpack_from(data, offset)
+		offset += INDEX_FILE_COUNT.size
+		check_fits(offset, 3 * count * item_size)
+		values = []
+		for j in range(3):
+			values.append(data[offset:offset + count * item_size].cast(INDEX_TYPECODE))
+			offset += count * item_size
+		all_pairs.append(DelimiterPairs(*values))
+
+	delimiters = dict((open_delim, pairs) for ((open_delim, _), pairs) in zip(LEXER_DELIMITERS, all_pairs))
+	return StructuralIndex(mask, delimiters, all_pairs[-1])
+
+def discard_index_file(path, mapped):
+	if mapped is not None:
+		try:
+			mapped.close()
+		except BufferError:
+			# NOTE: Still referenced, it gets unmapped once that's collected
+			pass
+
+	try:
+		os.remove(path)
+		l_debug('deleted index {path}', path=path)
+	except OSError:
+		pass
+
+def evict_index_cache(budget_bytes):
+	index_dir = get_index_cache_dir()
+	entries = []
+	for name in os.listdir(index_dir):
+		if not name.endswith(INDEX_FILE_EXTENSION):
+			continue
+		path = os.path.join(index_dir, name)
+		stat = os.stat(path)
+		entries.append((stat.st_mtime, stat.st_size, path))
+
+	total_size = sum(size for (_, size, _) in entries)
+	for (_, size, path) in sorted(entries):
+		if total_size <= budget_bytes:
+			break
+		try:
+			os.remove(path)
+			total_size -= size
+			l_debug('evicted index {path}', path=path)
+		except OSError:
+			# NOTE: Probably still mapped by a view (on Windows)
+			pass
+
+MAX_CACHED_MATCH_LISTS_PER_BUFFER = 8
+
+class BufferCache:
+	"""Everything derived purely from the text of a buffer, shared by all of
+	   the views of that buffer (e.g. the clones used to preview the start
+	   and end of the scope)."""
+	__slots__ = [
+		"view_ids",
+		"structural_index",
+		"usable_scopes",
+		"block_scopes",
+		"match_list_change_count",
+		"match_lists",
+		"symbol_functions",
+	]
+
+	def __init__(self):
+		# The views holding on to this cache
+		self.view_ids = set()
+		# (change count, syntax, StructuralIndex)
+		self.structural_index = None
+		# (change count, syntax, has usable scopes)
+		self.usable_scopes = None
+		# (change count, syntax, has meta.block scopes)
+		self.block_scopes = None
+		# The change count all of the match_lists are for
+		self.match_list_change_count = None
+		# (pattern, begin, end) -> list of Region
+		self.match_lists = OrderedDict()
+		# (change count, syntax, DelimiterPairs of function extents)
+		self.symbol_functions = None
+
+# buffer id -> BufferCache
+BUFFER_CACHES = {}
+
+def get_buffer_cache(view):
+	cache = BUFFER_CACHES.get(view.buffer_id())
+	if cache is None:
+		cache = BufferCache()
+		BUFFER_CACHES[view.buffer_id()] = cache
+
+	cache.view_ids.add(view.id())
+	return cache
+
+def release_buffer_cache(view):
+	cache = BUFFER_CACHES.get(view.buffer_id())
+	if cache is None:
+		return
+
+	cache.view_ids.discard(view.id())
+	if not cache.view_ids:
+		l_debug('dropping cache for buffer {buffer_id}', buffer_id = view.buffer_id())
+		del BUFFER_CACHES[view.buffer_id()]
+
+def get_structural_index(view, load_only=False):
+	key = view.id()
+	change_count = view.change_count()
+	syntax = view.settings().get('syntax')
+
+	buffer_cache = get_buffer_cache(view)
+	cached = buffer_cache.structural_index
+	if cached is not None and cached[0] == change_count and cached[1] == syntax:
+		return cached[2]
+
+	text = view.substr(sublime.Region(0, view.size()))
+
+	index = None
+	cache_path = None
+	# NOTE: Only the saved content, so editing a large file doesn't write
+	# a new index (that will never be loaded again) for every change
+	if should_persist_index(view) and not view.is_dirty():
+		cache_path = get_index_cache_path(text, syntax)
+		index = load_structural_index(cache_path)
+		if index is not None:
+			l_debug('loaded index for view {view_id} from {path}', view_id=key, path=cache_path)
+
+	if index is None:
+		if load_only:
+			return None
+
+		if has_usable_scopes(view):
+			index = index_scoped_text(view, text)
+		else:
+			index = lex_text(text, get_lexer_rules(view))
+		l_debug('indexed view {view_id} ({size} characters)', view_id=key, size=len(text))
+
+		if cache_path is not None:
+			sublime.set_timeout_async(lambda: save_structural_index(cache_path, index), 0)
+
+	buffer_cache.structural_index = (change_count, syntax, index)
+	return index
+
+def has_usable_scopes(view):
+	"""Whether the syntax marks up comments and strings for us"""
+	change_count = view.change_count()
+	syntax = view.settings().get('syntax')
+
+	buffer_cache = get_buffer_cache(view)
+	cached = buffer_cache.usable_scopes
+	if cached is not None and cached[0] == change_count and cached[1] == syntax:
+		return cached[2]
+
+	usable = bool(view.find_by_selector('comment') or view.find_by_selector('string'))
+	buffer_cache.usable_scopes = (change_count, syntax, usable)
+	return usable
+
+def has_block_scopes(view):
+	"""Whether the syntax marks up blocks with meta.block"""
+	change_count = view.change_count()
+	syntax = view.settings().get('syntax')
+
+	buffer_cache = get_buffer_cache(view)
+	cached = buffer_cache.block_scopes
+	if cached is not None and cached[0] == change_count and cached[1] == syntax:
+		return cached[2]
+
+	usable = bool(view.find_by_selector('meta.block'))
+	buffer_cache.block_scopes = (change_count, syntax, usable)
+	return usable
+
+def get_index_for_delimiters(view):
+	"""The structural index if it should be used instead of checking the
+	   scope of each delimiter, else None"""
+	# NOTE: Check for a persisted index first, so the first lookup after
+	# opening a large file doesn't have to search the whole buffer for scopes
+	if not should_persist_index(view) and has_usable_scopes(view):
+		return None
+
+	return get_structural_index(view)
+
+# Symbol kinds that can't have a body worth scoping to
+NON_FUNCTION_SYMBOL_KINDS = set(getattr(sublime, name) for name in [
+	'KIND_ID_VARIABLE', 'KIND_ID_MARKUP', 'KIND_ID_KEYWORD', 'KIND_ID_SNIPPET',
+] if hasattr(sublime, name))
+
+def get_definition_symbol_regions(view):
+	"""(begin, end) of the names of the symbols defined in the view"""
+	if hasattr(view, 'symbol_regions'):
+		definition = getattr(sublime, 'SYMBOL_TYPE_DEFINITION', None)
+		symbols = [s for s in view.symbol_regions()
+		           if (definition is None or s.type == definition) and
+		              s.kind[0] not in NON_FUNCTION_SYMBOL_KINDS]
+		if not symbols and hasattr(view, 'indexed_symbol_regions'):
+			symbols = [s for s in view.indexed_symbol_regions(definition)
+			           if s.kind[0] not in NON_FUNCTION_SYMBOL_KINDS]
+		return sorted((s.region.begin(), s.region.end()) for s in symbols)
+
+	# NOTE: Sublime Text 3
+	return sorted((region.begin(), region.end()) for (region, name) in view.symbols())
+
+def find_code(text, index, needle, start, end):
+	"""First `needle` between start and end that isn't in a comment or string"""
+	position = text.find(needle, start, end)
+	while position >= 0 and index.mask[position] != MASK_CODE:
+		position = text.find(needle, position + 1, end)
+	return position
+
+def get_indented_block_end(text, line_starts, line_number):
+	"""End of the last line indented further than `line_number`"""
+	def indent_of(n):
+		line_end = line_starts[n + 1] - 1 if n + 1 < len(line_starts) else len(text)
+		line = text[line_starts[n]:line_end]
+		stripped = line.lstrip()
+		return (len(line) - len(stripped), not stripped, line_end)
+
+	(base_indent, _, block_end) = indent_of(line_number)
+	for n in range(line_number + 1, len(line_starts)):
+		(indent, blank, line_end) = indent_of(n)
+		if blank:
+			continue
+		if indent <= base_indent:
+			break
+		block_end = line_end
+
+	return block_end
+
+# Characters that can be part of the declaration in front of a symbol's
+# name, e.g. its return type, modifiers and class name
+DECLARATION_CHARS = set('_$*&:.<>[],')
+
+def get_declaration_begin(text, index, line_start, symbol_begin):
+	"""Start of the words on the symbol's line that lead up to its name,
+	   stopping at anything else (e.g. the brace of an enclosing class)"""
+	begin = symbol_begin
+	position = symbol_begin - 1
+	while position >= line_start and index.mask[position] == MASK_CODE:
+		c = text[position]
+		if c.isalnum() or c in DECLARATION_CHARS:
+			begin = position
+		elif c not in ' \t':
+			break
+		position -= 1
+	return begin
+
+def build_symbol_functions(view):
+	"""Works out the extent of each symbol from the brace after its name,
+	   or the indentation after its line"""
+	text = view.substr(sublime.Region(0, view.size()))
+	index = get_structural_index(view)
+	braces = index.delimiters['{']
+	indented_blocks = get_lexer_rules(view).indented_blocks
+
+	line_starts = [0]
+	position = text.find('\n')
+	while position >= 0:
+		line_starts.append(position + 1)
+		position = text.find('\n', position + 1)
+
+	symbols = get_definition_symbol_regions(view)
+	symbol_begins = [symbol_begin for (symbol_begin, _) in symbols]
+	extents = []
+	for (i, (symbol_begin, symbol_end)) in enumerate(symbols):
+		line_number = bisect_right(line_starts, symbol_begin) - 1
+		extent_begin = get_declaration_begin(text, index, line_starts[line_number], symbol_begin)
+		extent_end = -1
+
+		if not indented_blocks:
+			# The body is the first brace before the next symbol, unless
+			# there's a `;` first (i.e. it's just a declaration)
+			bound = symbol_begins[i + 1] if i + 1 < len(symbol_begins) else len(text)
+			brace_index = bisect_left(braces.opens, symbol_end)
+			if brace_index < len(braces.opens) and braces.opens[brace_index] < bound:
+				open_brace = braces.opens[brace_index]
+				if find_code(text, index, ';', symbol_end, open_brace) < 0:
+					extent_end = braces.closes[brace_index] + 1
+
+		if extent_end < 0:
+			extent_end = get_indented_block_end(text, line_starts, line_number)
+
+		extents.append((extent_begin, extent_end))
+
+	l_debug('view {view_id} {count} functions from symbols',
+	        view_id = view.id(), count = len(extents))
+	return make_delimiter_pairs(extents)
+
+def get_symbol_functions(view):
+	"""Function extents inferred from the symbol list, for syntaxes
+	   without meta.function scopes"""
+	change_count = view.change_count()
+	syntax = view.settings().get('syntax')
+
+	buffer_cache = get_buffer_cache(view)
+	cached = buffer_cache.symbol_functions
+	if cached is not None and cached[0] == change_count and cached[1] == syntax:
+		return cached[2]
+
+	functions = build_symbol_functions(view)
+	buffer_cache.symbol_functions = (change_count, syntax, functions)
+	return functions
+
+def get_current_match_lists(view):
+	"""The buffer's cached match lists, dropping them all once the buffer
+	   changes, because they can never be used again"""
+	buffer_cache = get_buffer_cache(view)
+	change_count = view.change_count()
+	if buffer_cache.match_list_change_count != change_count:
+		buffer_cache.match_list_change_count = change_count
+		buffer_cache.match_lists.clear()
+	return buffer_cache.match_lists
+
+def get_cached_match_list(view, pattern, scope_region):
+	key = (pattern, scope_region.begin(), scope_region.end())
+	return get_current_match_lists(view).get(key)
+
+def cache_match_list(view, pattern, scope_region, matches):
+	key = (pattern, scope_region.begin(), scope_region.end())
+	match_lists = get_current_match_lists(view)
+	match_lists[key] = matches
+	match_lists.move_to_end(key)
+	while len(match_lists) > MAX_CACHED_MATCH_LISTS_PER_BUFFER:
+		match_lists.popitem(last=False)
+
+def get_quick_select_scope(view, first_sel, target_scope, repeat_count, quiet=False):
 	scope_region = sublime.Region(0, 0)
 	if (target_scope == "all"):
 		scope_region = sublime.Region(0, view.size())
 	elif (target_scope == "function"):
-		# TODO: Support languages that don't use "meta" markup
-		functions = view.find_by_selector("meta.function")
-		methods = view.find_by_selector("meta.methods")
 		current_point = first_sel.begin()
-		matching_functions = [r for r in functions + methods if r.contains(current_point)]
+		index = get_index_for_delimiters(view)
+		if index is not None and len(index.functions.opens) > 0:
+			function_pair = index.functions.find_enclosing(
+				sublime.Region(current_point, current_point), 0, inclusive=True)
+			matching_functions = [sublime.Region(*function_pair)] if function_pair else []
+		else:
+			functions = view.find_by_selector("meta.function")
+			methods = view.find_by_selector("meta.methods")
+			if functions or methods:
+				matching_functions = [r for r in functions + methods if r.contains(current_point)]
+			else:
+				# No "meta" markup, so go by the symbol list instead
+				function_pair = get_symbol_functions(view).find_enclosing(
+					sublime.Region(current_point, current_point), 0, inclusive=True)
+				matching_functions = [sublime.Region(*function_pair)] if function_pair else []
 		l_debug("matching regions: {matching_functions}", matching_functions=matching_functions)
 		if any(matching_functions):
 			scope_region = min(matching_functions, key=lambda x: x.size())
 		else:
-			view.window().status_message('No surrounding function could be found')
+			if not quiet:
+				view.window().status_message('No surrounding function could be found')
 			scope_region = sublime.Region(0, 0)
 
 	elif (target_scope == "parentheses"):
-		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '(', ')', 'parenthesis')
+		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '(', ')', 'parenthesis', quiet)
 	elif (target_scope == "selection"):
 		# TODO: support multiple selections
 		scope_region = first_sel
 	elif (target_scope == "curly braces"):
-		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '{', '}', 'curly brace')
+		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '{', '}', 'curly brace', quiet)
 	elif (target_scope == "square brackets"):
-		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '[', ']', 'square bracket')
+		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '[', ']', 'square bracket', quiet)
 	elif (target_scope == "angle brackets"):
-		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '<', '>', 'angle bracket')
+		scope_region = get_delimited_scope_region(view, first_sel, repeat_count, '<', '>', 'angle bracket', quiet)
 	elif (target_scope == "single quotes"):
 		# TODO: Need to be careful about escaped quotes here
 		l.warn('TODO: implement')
@@ -152,6 +1108,14 @@ def get_quick_select_scope(view, first_sel, target_scope, repeat_count):
 	elif (target_scope == "backticks"):
 		# TODO: Need to be careful about escaped backticks here
 		l.warn('TODO: implement')
+	elif (target_scope == "block" and not has_block_scopes(view)):
+		# No meta.block markup, so we match the braces ourselves
+		index = get_structural_index(view)
+		brace_pair = index.delimiters['{'].find_enclosing(first_sel, repeat_count)
+		if brace_pair is None:
+			scope_region = sublime.Region(0, view.size())
+		else:
+			scope_region = sublime.Region(brace_pair[0], brace_pair[1])
 	elif (target_scope == "block"):
 		cursor_scopes = view.scope_name(first_sel.begin())
 		num_blocks_of_cursor = cursor_scopes.count("meta.block")
@@ -247,6 +1211,8 @@ def clear_quick_select_scope(text_command, view, edit):
 
 	key = view.id()
 	view.erase_regions(SCOPE_MARKERS_KEY)
+	clear_match_highlight(view)
+	update_view_active(view)
 	if key in VIEW_DATA:
 		VIEW_DATA[key] = ViewData()
 		l_debug('Cleared scope for view ' + str(key))
@@ -298,6 +1264,7 @@ def restore_original_layout(view_data, view):
 		set_tabs_visible_in_place(view, True)
 
 	TEMP_VIEWS_SHOWING.discard(view.id())
+	update_view_active(view)
 	view_data.original_layout_info = None
 	view_data.start_clone = None
 	view_data.end_clone = None
@@ -323,6 +1290,7 @@ def mark_in_view(view, location):
 
 def register_temp_views_for_closure(view):
 	TEMP_VIEWS_SHOWING.add(view.id())
+	update_view_active(view)
 
 def show_start_and_end_in_other_pane(view, view_data, scope_region):
 	# Debounce the timer
@@ -379,11 +1347,13 @@ def show_start_and_end_in_other_pane(view, view_data, scope_region):
 			window.run_command('clone_file')
 			window.run_command('move_to_group', {'group': start_group})
 			view_data.start_clone = window.active_view()
+			update_view_active(view_data.start_clone)
 
 		if view_data.end_clone is None:
 			window.run_command('clone_file')
 			window.run_command('move_to_group', {'group': end_group})
 			view_data.end_clone = window.active_view()
+			update_view_active(view_data.end_clone)
 
 		view_data.start_clone.sel().add_all(view.sel())
 		view_data.end_clone.sel().add_all(view.sel())
@@ -441,11 +1411,16 @@ def set_quick_select_scope(text_command, view, edit, target_scope):
 	all_sel = view.sel()
 	first_sel = all_sel[0];
 
-	scope_region = get_quick_select_scope(view, first_sel, target_scope, repeat_count)
 	key = view.id()
-
 	view_data = VIEW_DATA.setdefault(key, ViewData())
-	view_data.visited_matches = []
+
+	scope_region = None
+	if target_scope in PREFETCH_TARGET_SCOPES:
+		scope_region = get_prefetched_scope(view, view_data, first_sel, target_scope, repeat_count)
+	if scope_region is None:
+		scope_region = get_quick_select_scope(view, first_sel, target_scope, repeat_count)
+
+	view_data.visited_matches = NO_VISITED_MATCHES
 	view_data.pattern = None
 	view_data.wrapped = False
 	view_data.original_cursor_location = None
@@ -457,6 +1432,8 @@ def set_quick_select_scope(text_command, view, edit, target_scope):
 			VIEW_DATA[key] = ViewData()
 			l.debug('Cleared scope for view ' + str(key))
 			view.erase_regions(SCOPE_MARKERS_KEY)
+			clear_match_highlight(view)
+			update_view_active(view)
 	else:
 		l_debug('Set scope {start} to {end}',
 				start=rowcol_one_based(view, scope_region.begin()),
@@ -468,77 +1445,214 @@ def set_quick_select_scope(text_command, view, edit, target_scope):
 		view.add_regions(SCOPE_MARKERS_KEY, scope_markers,
 		                 'scoped_quick_select.scope_marker',
 		                 flags=sublime.DRAW_EMPTY)
+		update_view_active(view)
 
 		# It's redundant to show the start/end if it's based on the selection
 		# from a user; they should already know the extent of the scope.
 		if (target_scope != 'selection'):
 			show_start_and_end_in_other_pane(view, view_data, scope_region)
 
-def get_marked_scope_region(view):
+		if get_setting('highlight_matches_in_scope', False):
+			schedule_match_highlight(view)
+
+		if target_scope in PREFETCH_TARGET_SCOPES:
+			schedule_scope_prefetch(view, first_sel, target_scope, repeat_count)
+
+def get_prefetch_key(view, first_sel, target_scope, repeat_count):
+	return (view.change_count(), target_scope, first_sel.a, first_sel.b, repeat_count)
+
+def get_prefetched_scope(view, view_data, first_sel, target_scope, repeat_count):
+	if repeat_count == 0:
+		return None
+
+	scope_region = view_data.prefetched_scopes.get(
+		get_prefetch_key(view, first_sel, target_scope, repeat_count))
+	if scope_region is None:
+		increment_counter('prefetch_misses')
+	else:
+		increment_counter('prefetch_hits')
+		l_debug('prefetched {target_scope} scope {repeat_count}',
+		        target_scope = target_scope, repeat_count = repeat_count)
+
+	return scope_region
+
+def schedule_scope_prefetch(view, first_sel, target_scope, repeat_count):
+	"""Work out the next few enclosing scopes on the async thread, on the
+	   assumption that the user is going to keep expanding the scope"""
+	prefetch_depth = get_setting('prefetch_depth', 2)
+	if prefetch_depth < 1:
+		return
+
+	change_count = view.change_count()
+
+	def prefetch():
+		view_data = VIEW_DATA.get(view.id())
+		if view_data is None:
+			return
+
+		for level in range(repeat_count + 1, repeat_count + 1 + prefetch_depth):
+			key = get_prefetch_key(view, first_sel, target_scope, level)
+			if key[0] != change_count:
+				l.debug('abandoned prefetch, buffer changed')
+				return
+
+			if key in view_data.prefetched_scopes:
+				continue
+
+			scope_region = get_quick_select_scope(view, first_sel, target_scope, level, quiet=True)
+			# NOTE: Nothing further out, the real command reports that
+			if scope_region.empty():
+				return
+
+			# Only the levels of the scope being expanded are ever looked up
+			# again, anything else (an older version of the buffer, another
+			# cursor position or target scope) is useless now
+			view_data.prefetched_scopes = dict(
+				(k, v) for (k, v) in view_data.prefetched_scopes.items() if k[:4] == key[:4])
+			view_data.prefetched_scopes[key] = scope_region
+			increment_counter('prefetched_scopes')
+
+	sublime.set_timeout_async(prefetch, 0)
+
+def get_marked_scope_region(view, clean_up=True):
 	marked_regions = view.get_regions(SCOPE_MARKERS_KEY)
 	if len(marked_regions) < 2:
 		# Clean up any single dangling region
-		view.erase_regions(SCOPE_MARKERS_KEY)
+		if clean_up:
+			view.erase_regions(SCOPE_MARKERS_KEY)
 		return None
 
 	start = marked_regions[0]
 	end = marked_regions[-1]
 	return sublime.Region(start.begin(), end.end())
 
+def schedule_match_highlight(view):
+	"""(Re)start highlighting the matches of the selection inside the marked
+	   scope, once the cursor has settled."""
+	key = view.id()
+	generation = MATCH_HIGHLIGHT_GENERATIONS.get(key, 0) + 1
+	MATCH_HIGHLIGHT_GENERATIONS[key] = generation
+
+	delay = get_setting('highlight_matches_delay_ms', 150)
+	sublime.set_timeout_async(lambda: start_match_highlight(view, generation), delay)
+
+def clear_match_highlight(view):
+	# NOTE: Bumping the generation cancels anything still in flight
+	key = view.id()
+	MATCH_HIGHLIGHT_GENERATIONS[key] = MATCH_HIGHLIGHT_GENERATIONS.get(key, 0) + 1
+	view.erase_regions(SCOPE_MATCHES_KEY)
+	view.erase_status(MATCH_COUNT_STATUS_KEY)
+
+def start_match_highlight(view, generation):
+	if MATCH_HIGHLIGHT_GENERATIONS.get(view.id()) != generation:
+		return
+
+	scope_region = get_marked_scope_region(view)
+	all_sel = view.sel()
+	if scope_region is None or len(all_sel) == 0:
+		clear_match_highlight(view)
+		return
+
+	selection = all_sel[0]
+	if selection.empty():
+		selected_text = view.substr(view.word(selection))
+	else:
+		selected_text = view.substr(selection)
+
+	if not selected_text.strip():
+		clear_match_highlight(view)
+		return
+
+	pattern = get_pattern_for_selection(view, selection)
+	matches = get_cached_match_list(view, pattern, scope_region)
+	if matches is not None:
+		show_match_highlight(view, pattern, matches)
+		return
+
+	continue_match_highlight(view, generation, view.change_count(),
+	                         pattern, scope_region, scope_region.begin(), [])
+
+def continue_match_highlight(view, generation, change_count, pattern, scope_region, position, matches):
+	"""Finds the next chunk of matches, and then yields the async thread
+	   so that huge scopes don't hold up anything else"""
+	if (MATCH_HIGHLIGHT_GENERATIONS.get(view.id()) != generation or
+	    view.change_count() != change_count):
+		return
+
+	chunk_size = get_setting('highlight_matches_chunk_size', 500)
+	for i in range(chunk_size):
+		match = view.find(pattern, position)
+		if match.a == -1 or match.end() > scope_region.end():
+			break
+
+		matches.append(match)
+		position = match.end() if not match.empty() else match.end() + 1
+	else:
+		sublime.set_timeout_async(
+			lambda: continue_match_highlight(view, generation, change_count,
+			                                 pattern, scope_region, position, matches), 0)
+		return
+
+	cache_match_list(view, pattern, scope_region, matches)
+	show_match_highlight(view, pattern, matches)
+
+def show_match_highlight(view, pattern, matches):
+	l_debug('view {view_id} {count} matches of {pattern} in scope',
+	        view_id = view.id(), count = len(matches), pattern = pattern)
+
+	view.add_regions(SCOPE_MATCHES_KEY, matches,
+	                 'scoped_quick_select.match',
+	                 flags=sublime.DRAW_NO_FILL)
+	view.set_status(MATCH_COUNT_STATUS_KEY,
+	                '{count} match{plural} in scope'.format(
+	                    count = len(matches), plural = '' if len(matches) == 1 else 'es'))
+
+def get_incremental_snapshot_key(view):
+	return (view.change_count(), hash(tuple((r.a, r.b) for r in view.sel())))
+
+def record_incremental_snapshot(view, view_data):
+	"""Remember the state that goes with the current selection, so that
+	   undoing/redoing back to it can restore the state exactly"""
+	key = get_incremental_snapshot_key(view)
+	view_data.snapshot_key = key
+
+	snapshots = INCREMENTAL_SNAPSHOTS.setdefault(view.id(), OrderedDict())
+	snapshots[key] = IncrementalSnapshot(view_data)
+	snapshots.move_to_end(key)
+	while len(snapshots) > MAX_INCREMENTAL_SNAPSHOTS_PER_VIEW:
+		snapshots.popitem(last=False)
+
+def deselect_previous_visit(view, view_data):
+	previous_visit = view_data.visited_matches.top
+	view.sel().subtract(previous_visit.region)
+	view_data.visited_matches = view_data.visited_matches.pop().push(
+		IncrementalMatch(False, previous_visit.region))
+
 def incremental_quick_select(text_command, view, edit, add):
 	l_debug('view {view_id} incremental_quick_select(add = {add})',
 	        view_id = view.id(), add = add)
 
 	view_data = VIEW_DATA.setdefault(view.id(), ViewData())
-
-	external_selection_change = False
-	for visited in view_data.visited_matches:
-		if not (view.sel().contains(visited.region) == visited.selected):
-			l.debug('view.sel() ' + str(view.sel()[0]) + ' does not contain ' + str(visited.region))
-			external_selection_change = True
-			break
+	snapshot_key = get_incremental_snapshot_key(view)
 
 	if (len(view.sel()) == 1 and view.sel()[0].empty()):
 		l.debug('single empty selection, blasting view_data')
-		external_selection_change = True
 		view_data = ViewData()
 		VIEW_DATA[view.id()] = view_data
-
-	keep_original_pattern = False
-	undo_count = 0
-	if external_selection_change:
-		l.debug('selection changed!')
-		redo_index = 1
-
-		(most_recent_command, _, _) = view.command_history(0)
-
-		# NOTE: This is definitely not how you're supposed to handle this
-		# but it works for the simple case of determining between the
-		# selection changing because the user moved the cursor manually
-		# and because they just did a "soft undo" (possibly repeatedly)
-		if most_recent_command == incremental_quick_select.__name__:
-			while True:
-				command_history = view.command_history(redo_index)
-				l.debug(str(command_history))
-				(redo_command, redo_args, repetitions) = command_history
-				redo_index += 1
-				if repetitions == 0:
-					break
-
-				if redo_command == incremental_quick_select.__name__:
-					undo_count += repetitions
-
-		view_data.wrapped = False
-
-		if undo_count == 0:
-			view_data.visited_matches = []
+	elif snapshot_key != view_data.snapshot_key:
+		# NOTE: Something other than our last step changed the selection.
+		# If it's a selection we produced before, then it was a
+		# (soft) undo/redo, so we just roll the state back to match.
+		snapshot = INCREMENTAL_SNAPSHOTS.get(view.id(), {}).get(snapshot_key)
+		if snapshot is not None:
+			l.debug('restoring snapshot for ' + str(snapshot_key))
+			view_data.restore(snapshot)
+		elif not all(view.sel().contains(visited.region) == visited.selected
+		             for visited in view_data.visited_matches):
+			l.debug('selection changed!')
+			view_data.visited_matches = NO_VISITED_MATCHES
 			view_data.original_cursor_location = None
-		else:
-			keep_original_pattern = True
-			for i in range(undo_count):
-				if view_data.visited_matches:
-					view_data.visited_matches.pop()
-
+			view_data.wrapped = False
 
 	# TODO: expand any single cursors to the surrounding words,
 	# but then carry on as usual
@@ -561,24 +1675,23 @@ def incremental_quick_select(text_command, view, edit, add):
 			# Arbitrarily pick the last one
 			original_selection = view.sel()[-1]
 
-			if not view_data.pattern or not keep_original_pattern:
-				view_data.pattern = get_pattern_for_selection(view, original_selection)
+			view_data.pattern = get_pattern_for_selection(view, original_selection)
 
 			if original_selection.size() < 1:
 				word_region = view.word(original_selection)
 				view_data.original_cursor_location = word_region.begin()
 				most_recent_cursor_location = word_region.begin()
-				view_data.visited_matches.append(IncrementalMatch(True, original_selection))
+				view_data.visited_matches = view_data.visited_matches.push(IncrementalMatch(True, original_selection))
 			else:
 				view_data.original_cursor_location = original_selection.begin()
 				most_recent_cursor_location = original_selection.end()
-				view_data.visited_matches.append(IncrementalMatch(True, original_selection))
+				view_data.visited_matches = view_data.visited_matches.push(IncrementalMatch(True, original_selection))
 				# NOTE: Correct the selection direction of the original selection
 				# if scope_region.contains(original_selection) and add:
 				# 	view.sel().add(sublime.Region(original_selection.begin(), original_selection.end()))
 		else:
 			if view_data.visited_matches:
-				most_recent_cursor_location = view_data.visited_matches[-1].region.end()
+				most_recent_cursor_location = view_data.visited_matches.top.region.end()
 			else:
 				most_recent_cursor_location = view_data.original_cursor_location
 
@@ -616,17 +1729,16 @@ def incremental_quick_select(text_command, view, edit, add):
 				view.sel().add(next_match)
 			else:
 				if view_data.visited_matches:
-					previous_visit = view_data.visited_matches[-1]
-					previous_visit.selected = False
-					view.sel().subtract(previous_visit.region)
+					deselect_previous_visit(view, view_data)
 
+			record_incremental_snapshot(view, view_data)
 			view.window().status_message("Incremental select complete")
 			return
 
 		if original_selection is not None and not scope_region.contains(original_selection):
 			l.debug('original_selection is outside scope_region')
-			view.sel().subtract(view_data.visited_matches[0].region)
-			view_data.visited_matches.pop()
+			view.sel().subtract(view_data.visited_matches.bottom.region)
+			view_data.visited_matches = view_data.visited_matches.pop()
 			view_data.original_cursor_location = next_match.begin()
 			# Don't count this as wrapping because we just changed the origin
 			view_data.wrapped = False
@@ -637,17 +1749,20 @@ def incremental_quick_select(text_command, view, edit, add):
 			view.sel().add(next_match)
 		else:
 			if view_data.visited_matches:
-				previous_visit = view_data.visited_matches[-1]
-				previous_visit.selected = False
-				view.sel().subtract(previous_visit.region)
+				deselect_previous_visit(view, view_data)
 			view.sel().add(next_match)
 
-		view_data.visited_matches.append(IncrementalMatch(True, next_match))
+		view_data.visited_matches = view_data.visited_matches.push(IncrementalMatch(True, next_match))
+		record_incremental_snapshot(view, view_data)
 		view.show(next_match)
 	finally:
 		view.end_edit(subedit)
 
-def get_delimited_scope_region(view, original_selection, repeat_count, open_delim, close_delim, name):
+def get_delimited_scope_region(view, original_selection, repeat_count, open_delim, close_delim, name, quiet=False):
+	index = get_index_for_delimiters(view)
+	if index is not None:
+		return get_indexed_delimited_scope_region(view, index, original_selection, repeat_count, open_delim, name, quiet)
+
 	search_end = original_selection.begin()
 	open_match_count = 0
 	block_start = search_end
@@ -662,7 +1777,8 @@ def get_delimited_scope_region(view, original_selection, repeat_count, open_deli
 
 		if block_start < 0:
 			l.debug('reached start of buffer')
-			view.window().status_message('No matching open ' + name)
+			if not quiet:
+				view.window().status_message('No matching open ' + name)
 			return sublime.Region(0, 0)
 
 		if other_block_end > block_start:
@@ -713,7 +1829,8 @@ def get_delimited_scope_region(view, original_selection, repeat_count, open_deli
 
 		if block_end < 0:
 			l.debug('reached end of buffer')
-			view.window().status_message('No matching close ' + name)
+			if not quiet:
+				view.window().status_message('No matching close ' + name)
 			return sublime.Region(0, 0)
 
 		block_end += search_start
@@ -759,6 +1876,22 @@ def get_delimited_scope_region(view, original_selection, repeat_count, open_deli
 	scope_region = sublime.Region(block_start, block_end)
 	return scope_region
 
+def get_indexed_delimited_scope_region(view, index, original_selection, repeat_count, open_delim, name, quiet=False):
+	delimiter_pair = index.delimiters[open_delim].find_enclosing(original_selection, repeat_count)
+	if delimiter_pair is None:
+		if not quiet:
+			view.window().status_message('No matching ' + name)
+		return sublime.Region(0, 0)
+
+	(block_start, block_end) = delimiter_pair
+	block_start += len(open_delim)
+	l_debug('{name} scope bounds (indexed): {start} to {end}',
+			name  = name,
+			start = rowcol_one_based(view, block_start),
+			end   = rowcol_one_based(view, block_end))
+
+	return sublime.Region(block_start, block_end)
+
 def regex_escape(text):
 	# NOTE: Sublime does not use python's regex engine so we can't just use
 	# `regex_escape()` and have it work. Sources seem to suggest that it is
@@ -794,76 +1927,572 @@ def get_pattern_for_selection(view, selection):
 def scoped_quick_select(text_command, view, edit, target_scope):
 	l_debug('view {view_id} scoped_quick_select({target_scope})',
 	        view_id = view.id(), target_scope = target_scope)
-	all_sel = view.sel()
-	selection = all_sel[0];
+	selection = view.sel()[0]
 
 	regex = get_pattern_for_selection(view, selection)
 
-	matches = view.find_all(regex)
-
 	scope_region = get_quick_select_scope(view, selection, target_scope, 0)
-	if scope_region.empty():
-		scoped_matches = []
-	else:
-		scoped_matches = [scope_region.intersection(m) for m in matches]
+	if scope_region is None or scope_region.empty():
+		return
 
-	scoped_matches = [m for m in scoped_matches if not m.empty()]
+	view_data = VIEW_DATA.setdefault(view.id(), ViewData())
+	page = SelectionPage(view.change_count(), regex, scope_region)
+	max_selections = get_max_selections()
+	selected_count = select_next_page(view, page, max_selections)
 
-	if any(scoped_matches):
-		view_data = VIEW_DATA.setdefault(view.id(), ViewData())
-		all_sel.add_all(scoped_matches)
+	# NOTE: Only counted, never stored, so a huge number of matches past
+	# the cap doesn't cost any memory
+	if selected_count == max_selections:
+		page.remaining = count_in_scope(view, regex, scope_region, page.resume_position)
+	update_selection_page(view, view_data, page)
+
+	if selected_count > 0:
 		show_start_and_end_in_other_pane(view, view_data, scope_region)
 
-class ScopedQuickSelectListener(sublime_plugin.EventListener):
-	registered_views = set()
-	color_schemes = set()
+def scoped_quick_select_next_page(text_command, view, edit):
+	l_debug('view {view_id} scoped_quick_select_next_page()', view_id = view.id())
+	view_data = VIEW_DATA.get(view.id())
+	page = view_data.selection_page if view_data is not None else None
+	if page is None:
+		view.window().status_message('No more matches to select')
+		return
 
-	def __init__(self):
-		# NOTE: Clear all scopes from previous sessions
-		for window in sublime.windows():
-			for view in window.views():
-				view.erase_regions(SCOPE_MARKERS_KEY)
+	if page.change_count != view.change_count():
+		view_data.selection_page = None
+		view.window().status_message('The buffer has changed since the matches were selected')
+		return
 
-	def on_activated_async(self, view):
-		if view.id() not in self.registered_views:
-			self.on_first_activation_async(view)
+	max_selections = get_max_selections()
+	selected_count = select_next_page(view, page, max_selections)
+	# NOTE: A page that isn't full means there's nothing left, whatever the
+	# count said
+	if selected_count == max_selections:
+		page.remaining -= selected_count
+	else:
+		page.remaining = 0
+	update_selection_page(view, view_data, page)
+	if page.remaining <= 0:
+		view.window().status_message('All matches selected')
+
+def get_max_selections():
+	"""The `max_selections` setting, or None for no cap if it isn't positive"""
+	max_selections = get_setting('max_selections', 10000)
+	return max_selections if max_selections > 0 else None
+
+def select_next_page(view, page, max_selections):
+	"""Adds up to `max_selections` of the page's matches to the selection
+	   (all of them if it's None), and returns how many were added"""
+	matches = scan_in_scope(view, page.pattern, page.scope_region, page.resume_position)
+	selected_count = 0
+
+	def track(matches):
+		nonlocal selected_count
+		for match in matches:
+			page.resume_position = match.end() if not match.empty() else match.end() + 1
+			selected_count += 1
+			yield match
+
+	view.sel().add_all(islice(track(matches), max_selections))
+	increment_counter('selected_matches', selected_count)
+	return selected_count
+
+def update_selection_page(view, view_data, page):
+	if page.remaining > 0:
+		view_data.selection_page = page
+		view.window().status_message(
+			'{count} more match{plural} not selected (ScopedQuickSelect: Select Next Page)'.format(
+				count = page.remaining,
+				plural = '' if page.remaining == 1 else 'es'))
+	else:
+		view_data.selection_page = None
+
+def scan_in_scope(view, pattern, scope_region, position):
+	"""Yields the matches of `pattern` from `position` on that are entirely
+	   inside `scope_region`, found in a single substr() of the scope
+	   instead of with a find() per match"""
+	# NOTE: One more character on each side, so word boundaries at the
+	# ends see the same text as view.find() does
+	text_region = sublime.Region(max(position - 1, 0), min(scope_region.end() + 1, view.size()))
+	text = view.substr(text_region)
+	offset = text_region.begin()
+	end = scope_region.end() - offset
+
+	# NOTE: Our patterns are only ever escaped text and word boundaries,
+	# which mean the same thing to python as they do to sublime.
+	for match in re.compile(pattern).finditer(text, position - offset):
+		if match.end() > end:
+			return
+		yield sublime.Region(match.start() + offset, match.end() + offset)
 
-		# Every activation:
-		pass
+def count_in_scope(view, pattern, scope_region, position):
+	return sum(1 for _ in scan_in_scope(view, pattern, scope_region, position))
 
-	def on_first_activation_async(self, view):
-		l.debug('registering ' + str(view.id()))
+def find_in_scope(view, pattern, scope_region):
+	"""Matches of `pattern` that are entirely inside `scope_region`"""
+	return list(scan_in_scope(view, pattern, scope_region, scope_region.begin()))
 
-		settings = view.settings()
-		settings.clear_on_change(PLUGIN_KEY)
-		settings.add_on_change(PLUGIN_KEY, lambda: self.settings_changed(view))
+def scoped_replace(text_command, view, edit, target_scope, replacement):
+	l_debug('view {view_id} scoped_replace({target_scope}, {replacement})',
+	        view_id = view.id(), target_scope = target_scope, replacement = replacement)
+	start_time = time.perf_counter()
 
-		self.setup_color_scheme(view)
-		self.registered_views.add(view.id())
+	selection = view.sel()[0]
+	scope_region = get_quick_select_scope(view, selection, target_scope, 0)
+	if scope_region is None or scope_region.empty():
+		view.window().status_message('No scope to replace in')
+		return
 
-	def on_pre_close(self, view):
-		l.debug('removing view ' + str(view.id()))
-		self.registered_views.discard(view.id())
+	pattern = get_pattern_for_selection(view, selection)
+	matches = find_in_scope(view, pattern, scope_region)
+
+	# NOTE: Back to front, so the earlier matches don't move as the
+	# later ones are replaced. All in the one edit, so it's a single undo.
+	for match in reversed(matches):
+		view.replace(edit, match, replacement)
+
+	elapsed_ms = (time.perf_counter() - start_time) * 1000
+	view.window().status_message('Replaced {count} occurrence{plural} in {elapsed_ms:.1f} ms'.format(
+		count = len(matches),
+		plural = '' if len(matches) == 1 else 's',
+		elapsed_ms = elapsed_ms))
+
+def get_worker_pool():
+	global WORKER_POOL
+	if WORKER_POOL is None:
+		WORKER_POOL = ThreadPoolExecutor(max_workers=get_setting('worker_threads', 4))
+	return WORKER_POOL
+
+def find_match_rows(name, text, row_offset, compiled_pattern, begin, end, max_rows):
+	"""Returns (`name:row:col: line` for each match between `begin` and `end`, total match count)"""
+	rows = []
+	count = 0
+	row = row_offset
+	last_position = 0
+	for match in compiled_pattern.finditer(text, begin):
+		if match.end() > end:
+			break
 
-	def on_load_async(self, view):
-		pass
+		count += 1
+		if count > max_rows:
+			continue
+
+		start = match.start()
+		row += text.count('\n', last_position, start)
+		last_position = start
+
+		line_start = text.rfind('\n', 0, start) + 1
+		line_end = text.find('\n', start)
+		if line_end < 0:
+			line_end = len(text)
+
+		rows.append('{name}:{row}:{col}: {line}'.format(
+			name = name, row = row + 1, col = start - line_start + 1,
+			line = text[line_start:line_end].strip()))
+
+	if count > max_rows:
+		rows.append('{name}: ... {count} more'.format(name = name, count = count - max_rows))
+
+	return (rows, count)
+
+def find_in_view_scope(view, target_scope, compiled_pattern, max_rows):
+	"""Worker side of scoped_find_across_views() for an open view"""
+	if target_scope == 'current_marked_scope':
+		# NOTE: Don't modify the view from a worker thread
+		scope_region = get_marked_scope_region(view, clean_up=False)
+	else:
+		scope_region = get_quick_select_scope(view, view.sel()[0], target_scope, 0, quiet=True)
+
+	if scope_region is None or scope_region.empty():
+		return ([], 0)
+
+	# NOTE: Whole lines, so each row can show the full line of the match
+	text_region = sublime.Region(view.line(scope_region.begin()).begin(),
+	                             view.line(scope_region.end()).end())
+	text = view.substr(text_region)
+	(row_offset, _) = view.rowcol(text_region.begin())
+
+	name = view.file_name() or view.name() or 'untitled ({view_id})'.format(view_id = view.id())
+	return find_match_rows(name, text, row_offset, compiled_pattern,
+	                       scope_region.begin() - text_region.begin(),
+	                       scope_region.end() - text_region.begin(),
+	                       max_rows)
+
+def find_in_files(paths, compiled_pattern, max_rows):
+	"""Worker side of scoped_find_across_views() for files that aren't open.
+	   There's no cursor or marked scope, so the whole file is the scope."""
+	all_rows = []
+	total_count = 0
+	for path in paths:
+		try:
+			with open(path, 'r', encoding='utf-8', errors='replace') as f:
+				text = f.read()
+		except OSError as e:
+			l_debug('could not read {path}: {error}', path = path, error = e)
+			continue
+
+		(rows, count) = find_match_rows(path, text, 0, compiled_pattern, 0, len(text), max_rows)
+		all_rows.extend(rows)
+		total_count += count
+
+	return (all_rows, total_count)
+
+class ProjectFolder:
+	"""A folder to search, and what to leave out of it (the same as Find
+	   in Files does)"""
+	__slots__ = ["path", "folder_exclude_patterns", "file_exclude_patterns"]
+
+	def __init__(self, path, folder_exclude_patterns, file_exclude_patterns):
+		self.path = path
+		self.folder_exclude_patterns = folder_exclude_patterns
+		self.file_exclude_patterns = file_exclude_patterns
+
+def get_project_folders(window, view):
+	"""Gathered on the main thread, for get_project_files()"""
+	def get_patterns(settings):
+		folder_patterns = list(settings.get('folder_exclude_patterns') or [])
+		file_patterns = []
+		for name in ('file_exclude_patterns', 'binary_file_patterns'):
+			for pattern in settings.get(name) or []:
+				# NOTE: e.g. "node_modules/" in binary_file_patterns
+				if pattern.endswith('/'):
+					folder_patterns.append(pattern.rstrip('/'))
+				else:
+					file_patterns.append(pattern)
+		return (folder_patterns, file_patterns)
+
+	# NOTE: The view's settings include the user's and the project's
+	(folder_patterns, file_patterns) = get_patterns(view.settings())
+	project_folders = (window.project_data() or {}).get('folders') or []
+
+	folders = []
+	for (i, path) in enumerate(window.folders()):
+		# NOTE: Each project folder can add patterns of its own
+		folder_data = project_folders[i] if i < len(project_folders) else {}
+		(own_folder_patterns, own_file_patterns) = get_patterns(folder_data)
+		folders.append(ProjectFolder(path,
+		                             folder_patterns + own_folder_patterns,
+		                             file_patterns + own_file_patterns))
+	return folders
+
+def matches_any_pattern(name, relative_path, patterns):
+	for pattern in patterns:
+		# NOTE: Patterns with a slash are for a path inside the folder
+		if '/' in pattern:
+			if fnmatch.fnmatch(relative_path, pattern.lstrip('/')):
+				return True
+		elif fnmatch.fnmatch(name, pattern):
+			return True
+	return False
+
+def get_project_files(folders, extensions, max_size):
+	"""Worker side of scoped_find_across_views() for listing the project's
+	   files. All of them, unless `extensions` is given, leaving out
+	   excluded, binary and overly large files."""
+	if extensions is not None:
+		extensions = set(extension.lower() for extension in extensions)
+
+	files = []
+	for folder in folders:
+		for (root, dir_names, file_names) in os.walk(folder.path):
+			relative_root = os.path.relpath(root, folder.path).replace(os.sep, '/')
+			if relative_root == '.':
+				relative_root = ''
+			else:
+				relative_root += '/'
+
+			dir_names[:] = [d for d in dir_names
+			                if not matches_any_pattern(d, relative_root + d, folder.folder_exclude_patterns)]
+			for file_name in file_names:
+				if extensions is not None and os.path.splitext(file_name)[1].lower() not in extensions:
+					continue
+				if matches_any_pattern(file_name, relative_root + file_name, folder.file_exclude_patterns):
+					continue
+
+				path = os.path.join(root, file_name)
+				try:
+					if os.path.getsize(path) > max_size:
+						l_debug('skipping large file {path}', path = path)
+						continue
+				except OSError:
+					continue
+
+				files.append(path)
+	return files
+
+def scoped_find_across_views(window_command, window, target_scope, files, project):
+	global CROSS_VIEW_SEARCH_GENERATION
+	CROSS_VIEW_SEARCH_GENERATION += 1
+	generation = CROSS_VIEW_SEARCH_GENERATION
+
+	active_view = window.active_view()
+	if active_view is None or len(active_view.sel()) == 0:
+		return
 
-	def on_modified(self, view):
-		#l_debug('on_modified {view}', view = view)
+	pattern = get_pattern_for_selection(active_view, active_view.sel()[0])
+	l_debug('scoped_find_across_views({target_scope}, {pattern})',
+	        target_scope = target_scope, pattern = pattern)
+
+	# NOTE: Our patterns are only ever escaped text and word boundaries,
+	# which mean the same thing to python as they do to sublime.
+	compiled_pattern = re.compile(pattern)
+	max_rows = get_setting('max_results_per_view', 1000)
+
+	# Files that are already open are searched through their views instead
+	open_files = set(view.file_name() for view in window.views() if view.file_name())
+
+	panel = window.create_output_panel(RESULTS_PANEL_NAME)
+	panel.settings().set('result_file_regex', r'^(.+):(\d+):(\d+): ')
+	window.run_command('show_panel', {'panel': 'output.' + RESULTS_PANEL_NAME})
+
+	def append_to_panel(text):
+		if generation == CROSS_VIEW_SEARCH_GENERATION:
+			panel.run_command('append', {'characters': text, 'force': True})
+
+	append_to_panel('Searching for {pattern} in {scope}\n\n'.format(pattern = pattern, scope = target_scope))
+
+	pool = get_worker_pool()
+	start_time = time.perf_counter()
+	# NOTE: Only touched on the main thread
+	remaining = [0]
+	target_count = [0]
+	total_count = [0]
+
+	def finish_if_done():
+		if remaining[0] == 0:
+			append_to_panel('{count} match{plural} in {targets} views/files ({elapsed_ms:.1f} ms)\n'.format(
+				count = total_count[0],
+				plural = '' if total_count[0] == 1 else 'es',
+				targets = target_count[0],
+				elapsed_ms = (time.perf_counter() - start_time) * 1000))
+
+	def on_done(future):
+		# NOTE: Called on the worker thread
+		if generation != CROSS_VIEW_SEARCH_GENERATION:
+			return
+
+		try:
+			(rows, count) = future.result()
+		except Exception:
+			l.exception('scoped find failed')
+			(rows, count) = ([], 0)
+
+		def update_panel():
+			total_count[0] += count
+			remaining[0] -= 1
+			if rows:
+				append_to_panel('\n'.join(rows) + '\n\n')
+			finish_if_done()
+
+		sublime.set_timeout(update_panel, 0)
+
+	def submit(targets, fn, *args):
+		remaining[0] += 1
+		target_count[0] += targets
+		pool.submit(fn, *args).add_done_callback(on_done)
+
+	def submit_files(paths):
+		paths = [path for path in paths if path not in open_files]
+		for i in range(0, len(paths), FILES_PER_SEARCH_TASK):
+			batch = paths[i:i + FILES_PER_SEARCH_TASK]
+			submit(len(batch), find_in_files, batch, compiled_pattern, max_rows)
+
+	for view in window.views():
+		submit(1, find_in_view_scope, view, target_scope, compiled_pattern, max_rows)
+
+	if not project:
+		submit_files(files or [])
+		finish_if_done()
+		return
+
+	# NOTE: Walking the project can take a while, so it happens on the
+	# pool too, and the files are searched once it's done
+	def on_walked(future):
+		# NOTE: Called on the worker thread
+		if generation != CROSS_VIEW_SEARCH_GENERATION:
+			return
+
+		try:
+			paths = future.result()
+		except Exception:
+			l.exception('listing the project files failed')
+			paths = []
+
+		def search_project_files():
+			remaining[0] -= 1
+			submit_files(paths)
+			finish_if_done()
+
+		sublime.set_timeout(search_project_files, 0)
+
+	remaining[0] += 1
+	pool.submit(get_project_files, get_project_folders(window, active_view),
+	            get_setting('project_file_extensions', None),
+	            get_setting('project_file_max_size', 4 * 1024 * 1024)).add_done_callback(on_walked)
+
+def show_quick_select_stats(window_command, window):
+	for name in sorted(PERF_COUNTERS):
+		l.info('{name}: {value}'.format(name = name, value = PERF_COUNTERS[name]))
+
+		if name.endswith('.calls'):
+			event_name = name[:-len('.calls')]
+			seconds = PERF_COUNTERS.get(event_name + '.seconds', 0.0)
+			l.info('{event_name} average: {average_us:.1f} us'.format(
+				event_name = event_name,
+				average_us = 1000000.0 * seconds / PERF_COUNTERS[name]))
+
+	hits = PERF_COUNTERS.get('prefetch_hits', 0)
+	lookups = hits + PERF_COUNTERS.get('prefetch_misses', 0)
+	hit_rate = 100.0 * hits / lookups if lookups else 0.0
+	window.status_message('Prefetch hit rate: {hit_rate:.0f}% ({hits}/{lookups})'.format(
+		hit_rate = hit_rate, hits = hits, lookups = lookups))
+
+class TraceRecorder:
+	"""Writes the text commands run in a view to a JSONL trace, along with
+	   a copy of the buffer whenever it changes in a way the replayer can't
+	   reproduce, so that the interaction can be replayed headlessly (see
+	   `replay/replay.py`)"""
+	__slots__ = ["path", "trace_file", "view", "last_change_count", "expected_size"]
+
+	def __init__(self, path, view):
+		self.path = path
+		self.trace_file = open(path, 'w', encoding='utf-8')
+		self.view = view
+		self.last_change_count = None
+		# Size of the buffer once the last command is replayed, if the
+		# replayer can reproduce its change
+		self.expected_size = None
+
+	def write(self, record):
+		self.trace_file.write(json.dumps(record) + '\n')
+
+	def record_command(self, view, command_name, args):
+		change_count = view.change_count()
+		if change_count != self.last_change_count:
+			# NOTE: Typing is replayed by inserting the same characters, so
+			# the whole buffer isn't written again for every keystroke.
+			# Anything else (e.g. auto indentation) changes the size.
+			if view.size() != self.expected_size:
+				self.write({
+					'type': 'buffer',
+					'text': view.substr(sublime.Region(0, view.size())),
+					'syntax': view.settings().get('syntax'),
+					'file_name': view.file_name(),
+				})
+			self.last_change_count = change_count
+
+		selection = [[r.a, r.b] for r in view.sel()]
+		self.write({
+			'type': 'command',
+			'command': command_name,
+			'args': args,
+			'selection': selection,
+		})
+
+		self.expected_size = None
+		if command_name == 'insert':
+			characters = (args or {}).get('characters', '')
+			self.expected_size = view.size() + sum(
+				len(characters) - abs(b - a) for (a, b) in selection)
+
+	def close(self):
+		self.trace_file.close()
+
+def start_quick_select_recording(text_command, view, path):
+	global TRACE_RECORDER
+	if TRACE_RECORDER is not None:
+		stop_quick_select_recording(None, view.window())
+
+	if path is None:
+		trace_dir = os.path.join(sublime.cache_path(), PLUGIN_KEY, 'traces')
+		os.makedirs(trace_dir, exist_ok = True)
+		path = os.path.join(trace_dir, time.strftime('%Y%m%d-%H%M%S') + '.jsonl')
+
+	TRACE_RECORDER = TraceRecorder(path, view)
+	view.settings().set(RECORDING_VIEW_SETTING, True)
+	recheck_view_listeners(view)
+
+	view.window().status_message('Recording to ' + path)
+
+def stop_quick_select_recording(window_command, window):
+	global TRACE_RECORDER
+	if TRACE_RECORDER is None:
+		return
+
+	view = TRACE_RECORDER.view
+	view.settings().erase(RECORDING_VIEW_SETTING)
+	recheck_view_listeners(view)
+
+	TRACE_RECORDER.close()
+	window.status_message('Recorded ' + TRACE_RECORDER.path)
+	TRACE_RECORDER = None
+
+def recheck_view_listeners(view):
+	"""Sublime only re-checks `is_applicable()` on certain events, so make
+	   sure it notices a change to one of our view settings straight away"""
+	check_view_event_listeners = getattr(sublime_plugin, 'check_view_event_listeners', None)
+	if check_view_event_listeners is not None:
+		check_view_event_listeners(view)
+
+def update_view_active(view):
+	"""Attach/detach the view listener depending on whether we have any
+	   scope or preview state for the view"""
+	active = bool(view.get_regions(SCOPE_MARKERS_KEY)) or view.id() in TEMP_VIEWS_SHOWING
+	settings = view.settings()
+	if bool(settings.get(ACTIVE_VIEW_SETTING, False)) == active:
+		return
+
+	l_debug('view {view_id} active: {active}', view_id = view.id(), active = active)
+	if active:
+		settings.set(ACTIVE_VIEW_SETTING, True)
+	else:
+		settings.erase(ACTIVE_VIEW_SETTING)
+
+	recheck_view_listeners(view)
+
+def instrumented(event_name):
+	"""Count the calls to, and the time spent in, an event handler"""
+	def decorator(handler):
+		@functools.wraps(handler)
+		def wrapper(*args, **kwargs):
+			start_time = time.perf_counter()
+			try:
+				return handler(*args, **kwargs)
+			finally:
+				increment_counter(event_name + '.calls')
+				increment_counter(event_name + '.seconds', time.perf_counter() - start_time)
+		return wrapper
+	return decorator
+
+class ScopedQuickSelectViewListener(sublime_plugin.ViewEventListener):
+	@classmethod
+	def is_applicable(cls, settings):
+		return bool(settings.get(ACTIVE_VIEW_SETTING, False))
+
+	@instrumented('on_selection_modified_async')
+	def on_selection_modified_async(self):
+		if HIGHLIGHT_MATCHES_IN_SCOPE:
+			schedule_match_highlight(self.view)
+
+	@instrumented('on_modified')
+	def on_modified(self):
+		#l_debug('on_modified {view}', view = self.view)
+		view = self.view
 		if view.id() in TEMP_VIEWS_SHOWING:
 			trigger_restore_original_layout(VIEW_DATA[view.id()], view)
 
-	def on_text_command(self, view, command_name, args):
+	@instrumented('on_text_command')
+	def on_text_command(self, command_name, args):
 		#l_debug('on_text_command {view}, {command_name}, {args}',
-		#        view = view, command_name = command_name, args = args)
+		#        view = self.view, command_name = command_name, args = args)
 
+		view = self.view
 		if command_name != 'set_quick_select_scope':
 			if view.id() in TEMP_VIEWS_SHOWING:
 				trigger_restore_original_layout(VIEW_DATA[view.id()], view)
 
 		return None
 
-	def on_query_context(self, view, key, operator, operand, match_all):
+	def on_query_context(self, key, operator, operand, match_all):
 		def test(a):
 			if operator == sublime.OP_EQUAL:
 				return a == operand
@@ -872,10 +2501,70 @@ class ScopedQuickSelectListener(sublime_plugin.EventListener):
 			return False
 
 		if key == "scoped_quick_select_preview_showing":
-			return test(view.id() in TEMP_VIEWS_SHOWING)
+			return test(self.view.id() in TEMP_VIEWS_SHOWING)
+
+		return None
+
+class ScopedQuickSelectRecorder(sublime_plugin.ViewEventListener):
+	@classmethod
+	def is_applicable(cls, settings):
+		return bool(settings.get(RECORDING_VIEW_SETTING, False))
 
+	def on_text_command(self, command_name, args):
+		if TRACE_RECORDER is not None and TRACE_RECORDER.view.id() == self.view.id():
+			TRACE_RECORDER.record_command(self.view, command_name, args)
 		return None
 
+class ScopedQuickSelectListener(sublime_plugin.EventListener):
+	registered_views = set()
+	color_schemes = set()
+
+	def __init__(self):
+		for window in sublime.windows():
+			for view in window.views():
+				# NOTE: Clear all scopes from previous sessions
+				view.erase_regions(SCOPE_MARKERS_KEY)
+				view.erase_regions(SCOPE_MATCHES_KEY)
+				view.settings().erase(ACTIVE_VIEW_SETTING)
+				view.settings().erase(RECORDING_VIEW_SETTING)
+				self.register_view(view)
+
+	# NOTE: Views are registered once when they're created, rather
+	# than checking on every activation
+	def on_new_async(self, view):
+		self.register_view(view)
+
+	def on_clone_async(self, view):
+		self.register_view(view)
+
+	def register_view(self, view):
+		if view.id() in self.registered_views:
+			return
+
+		l.debug('registering ' + str(view.id()))
+
+		settings = view.settings()
+		settings.clear_on_change(PLUGIN_KEY)
+		settings.add_on_change(PLUGIN_KEY, lambda: self.settings_changed(view))
+
+		self.setup_color_scheme(view)
+		self.registered_views.add(view.id())
+
+	def on_pre_close(self, view):
+		l.debug('removing view ' + str(view.id()))
+		self.registered_views.discard(view.id())
+		release_buffer_cache(view)
+		MATCH_HIGHLIGHT_GENERATIONS.pop(view.id(), None)
+		INCREMENTAL_SNAPSHOTS.pop(view.id(), None)
+
+	def on_load_async(self, view):
+		self.register_view(view)
+
+		# NOTE: Pull in any persisted index up front, so the first
+		# lookup doesn't have to hash the whole file
+		if should_persist_index(view):
+			get_structural_index(view, load_only=True)
+
 	def settings_changed(self, view):
 		self.setup_color_scheme(view)
 
@@ -909,9 +2598,28 @@ class ScopedQuickSelectListener(sublime_plugin.EventListener):
 		l_debug("copying '{source}' to '{dest}'", source=source_scheme_path, dest=scheme_dest_path)
 		shutil.copy(source_scheme_path, scheme_dest_path)
 
+def increment_counter(name, amount=1):
+	PERF_COUNTERS[name] = PERF_COUNTERS.get(name, 0) + amount
+
+def plugin_settings_changed():
+	global HIGHLIGHT_MATCHES_IN_SCOPE
+	HIGHLIGHT_MATCHES_IN_SCOPE = bool(get_setting('highlight_matches_in_scope', False))
+
+def get_setting(name, default=None):
+	return sublime.load_settings(PLUGIN_KEY + '.sublime-settings').get(name, default)
+
 def l_debug(msg, **kwargs):
 	l.debug(msg.format(**kwargs))
 
+def plugin_unloaded():
+	if WORKER_POOL is not None:
+		WORKER_POOL.shutdown(wait=False)
+
+	if TRACE_RECORDER is not None:
+		TRACE_RECORDER.close()
+
+	sublime.load_settings(PLUGIN_KEY + '.sublime-settings').clear_on_change(PLUGIN_KEY)
+
 def plugin_loaded():
 	pl = logging.getLogger(__package__)
 	for handler in pl.handlers[:]:
@@ -925,3 +2633,8 @@ def plugin_loaded():
 
 	pl.setLevel(DEFAULT_LOG_LEVEL)
 	l.debug('plugin_loaded')
+
+	settings = sublime.load_settings(PLUGIN_KEY + '.sublime-settings')
+	settings.clear_on_change(PLUGIN_KEY)
+	settings.add_on_change(PLUGIN_KEY, plugin_settings_changed)
+	plugin_settings_changed()
@@ -0,0 +1,151 @@
+"""Measures what the plugin's event listeners cost while typing, by sending
+each listener the events Sublime would for every keystroke.
+
+	python3 replay/listener_overhead.py [PLUGIN ...]
+
+e.g. to compare with an older version of the plugin:
+
+	git show <commit>:default.py > /tmp/before.py
+	python3 replay/listener_overhead.py /tmp/before.py default.py
+
+Each handler call is a round trip to the plugin host in Sublime, so the
+number of calls matters as much as the time spent in them. Like Sublime,
+handlers are only called if the listener defines them, and a
+ViewEventListener only gets the events of views it `is_applicable()` to."""
+
+import argparse
+import os
+import sys
+import time
+
+REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPLAY_DIR)
+
+import sublime
+import sublime_plugin
+import replay
+
+# The events Sublime sends for each character typed
+KEYSTROKE_EVENTS = [
+	'on_text_command',
+	'on_modified',
+	'on_modified_async',
+	'on_selection_modified',
+	'on_selection_modified_async',
+	'on_post_text_command',
+]
+
+ACTIVATION_EVENTS = ['on_activated', 'on_activated_async']
+
+class Dispatcher:
+	"""Sends events to a plugin's listeners, and adds up what they cost"""
+	__slots__ = ["global_listeners", "view_listener_classes", "view_listeners",
+	             "calls", "seconds", "api_calls"]
+
+	def __init__(self, plugin):
+		self.global_listeners = [
+			value() for value in vars(plugin).values()
+			if isinstance(value, type) and issubclass(value, sublime_plugin.EventListener)
+			and value is not sublime_plugin.EventListener]
+		self.view_listener_classes = [
+			value for value in vars(plugin).values()
+			if isinstance(value, type) and issubclass(value, sublime_plugin.ViewEventListener)
+			and value is not sublime_plugin.ViewEventListener]
+		# (view id, class) -> instance
+		self.view_listeners = {}
+		self.calls = 0
+		self.seconds = 0.0
+		self.api_calls = 0
+
+	def listeners_for(self, view):
+		# NOTE: Checking is_applicable() isn't counted, Sublime only does
+		# it when the view's settings change
+		for listener_class in self.view_listener_classes:
+			key = (view.id(), listener_class)
+			if listener_class.is_applicable(view.settings()):
+				if key not in self.view_listeners:
+					self.view_listeners[key] = listener_class(view)
+				yield self.view_listeners[key]
+			else:
+				self.view_listeners.pop(key, None)
+
+	def send(self, view, event, *args):
+		handlers = [getattr(listener, event) for listener in self.global_listeners
+		            if hasattr(listener, event)]
+		view_handlers = [getattr(listener, event) for listener in self.listeners_for(view)
+		                 if hasattr(listener, event)]
+
+		sublime.API_CALLS.clear()
+		start_time = time.perf_counter()
+		for handler in handlers:
+			handler(view, *args)
+		for handler in view_handlers:
+			handler(*args)
+		self.seconds += time.perf_counter() - start_time
+		self.api_calls += sum(sublime.API_CALLS.values())
+		self.calls += len(handlers) + len(view_handlers)
+
+def type_in_views(plugin_path, view_count, keystrokes_per_view, marked_scope):
+	plugin = replay.load_plugin(plugin_path)
+	window = sublime.Window()
+	window._text_commands = replay.get_commands(plugin, sublime_plugin.TextCommand)
+	window._window_commands = replay.get_commands(plugin, sublime_plugin.WindowCommand)
+
+	views = []
+	for i in range(view_count):
+		view = window.new_file()
+		view._set_text('void handler_{i}(int value) {{\n\treturn value;\n}}\n'.format(i = i))
+		view._set_selection([(len(view._text) - 3, len(view._text) - 3)])
+		views.append(view)
+
+	dispatcher = Dispatcher(plugin)
+	for view in views:
+		if marked_scope:
+			view.run_command('set_quick_select_scope', {'scope': 'curly braces'})
+		sublime.run_deferred()
+
+	for view in views:
+		for event in ACTIVATION_EVENTS:
+			dispatcher.send(view, event)
+
+		for i in range(keystrokes_per_view):
+			args = {'characters': 'x'}
+			for event in KEYSTROKE_EVENTS:
+				if event in ('on_text_command', 'on_post_text_command'):
+					dispatcher.send(view, event, 'insert', args)
+				else:
+					dispatcher.send(view, event)
+				if event == 'on_text_command':
+					replay.emulate_builtin(view, 'insert', args, [])
+			sublime.run_deferred()
+
+	if hasattr(plugin, 'plugin_unloaded'):
+		plugin.plugin_unloaded()
+
+	return dispatcher
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('plugins', nargs='*', default=[replay.PLUGIN_PATH])
+	parser.add_argument('--views', type=int, default=10)
+	parser.add_argument('--keystrokes', type=int, default=1000,
+	                    help='characters typed in each view')
+	args = parser.parse_args()
+
+	keystrokes = args.views * args.keystrokes
+	print('{:<28} {:<14} {:>15} {:>15} {:>15}'.format(
+		'plugin', 'views', 'calls/key', 'api calls/key', 'us/key'))
+	for plugin_path in args.plugins:
+		for marked_scope in (False, True):
+			dispatcher = type_in_views(plugin_path, args.views, args.keystrokes, marked_scope)
+			print('{:<28} {:<14} {:>15.2f} {:>15.2f} {:>15.2f}'.format(
+				os.path.basename(plugin_path),
+				'marked scope' if marked_scope else 'no state',
+				dispatcher.calls / keystrokes,
+				dispatcher.api_calls / keystrokes,
+				dispatcher.seconds / keystrokes * 1e6))
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
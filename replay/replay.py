@@ -0,0 +1,242 @@
+"""Replays a trace recorded with `start_quick_select_recording` against a
+headless stand-in for Sublime, and reports the latency and number of API
+calls for each of the plugin's commands.
+
+	python replay/replay.py TRACE [--baseline FILE [--update-baseline]]
+
+With a baseline, any step that makes more API calls than before is
+reported, and the exit status is 1. With `--check-latency`, so is any step
+that is slower than `--tolerance` times the baseline (and by more than
+`--slack-ms`). That's only meaningful on the machine that recorded the
+baseline, so it's off by default.
+
+Only the plugin's own commands are run. `insert` and `soft_undo` are
+emulated well enough to keep the buffer and selection in step, and every
+other command (cursor movement etc.) is skipped, relying on the buffer
+and selection recorded in the trace instead."""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPLAY_DIR)
+
+import sublime
+import sublime_plugin
+
+PLUGIN_PATH = os.path.join(os.path.dirname(REPLAY_DIR), 'default.py')
+
+class Step:
+	__slots__ = ["command", "ms", "api_calls", "deferred_ms", "deferred_api_calls"]
+
+	def __init__(self, command, ms, api_calls, deferred_ms, deferred_api_calls):
+		self.command = command
+		self.ms = ms
+		self.api_calls = api_calls
+		self.deferred_ms = deferred_ms
+		self.deferred_api_calls = deferred_api_calls
+
+	def to_json(self):
+		return {
+			'command': self.command,
+			'ms': round(self.ms, 3),
+			'api_calls': self.api_calls,
+			'deferred_ms': round(self.deferred_ms, 3),
+			'deferred_api_calls': self.deferred_api_calls,
+		}
+
+def load_plugin(path=PLUGIN_PATH):
+	"""A fresh copy of the plugin, so no state carries over between runs"""
+	sublime._reset()
+	spec = importlib.util.spec_from_file_location('default', path)
+	plugin = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(plugin)
+	if hasattr(plugin, 'plugin_loaded'):
+		plugin.plugin_loaded()
+	return plugin
+
+def get_commands(plugin, base_class):
+	commands = {}
+	for value in vars(plugin).values():
+		if isinstance(value, type) and issubclass(value, base_class) and value is not base_class:
+			commands[value(None).name()] = value
+	return commands
+
+def read_trace(path):
+	with open(path, 'r', encoding='utf-8') as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+def emulate_builtin(view, command_name, args, undo_stack):
+	"""Returns whether `command_name` was emulated"""
+	if command_name == 'insert':
+		characters = args.get('characters', '')
+		regions = list(view._sel)
+		for region in reversed(regions):
+			view._set_text(view._text[:region.begin()] + characters + view._text[region.end():])
+
+		# NOTE: Every cursor also moves by the text inserted/replaced before it
+		cursors = []
+		shift = 0
+		for region in regions:
+			cursor = region.begin() + shift + len(characters)
+			cursors.append((cursor, cursor))
+			shift += len(characters) - region.size()
+		view._set_selection(cursors)
+		return True
+
+	if command_name == 'soft_undo':
+		if undo_stack:
+			(text, selection) = undo_stack.pop()
+			view._set_text(text)
+			view._set_selection(selection)
+		return True
+
+	return False
+
+def replay(records, settings_overrides):
+	sublime.SETTINGS_OVERRIDES.clear()
+	sublime.SETTINGS_OVERRIDES.update(settings_overrides)
+
+	plugin = load_plugin()
+	window = sublime.Window()
+	window._text_commands = get_commands(plugin, sublime_plugin.TextCommand)
+	window._window_commands = get_commands(plugin, sublime_plugin.WindowCommand)
+	view = window.new_file()
+
+	undo_stack = []
+	steps = []
+	for record in records:
+		if record['type'] == 'buffer':
+			view._set_text(record['text'])
+			if record.get('syntax'):
+				view.settings().set('syntax', record['syntax'])
+			view._file_name = record.get('file_name')
+			view._mark_saved()
+			continue
+
+		command_name = record['command']
+		args = record.get('args') or {}
+		if 'selection' in record:
+			view._set_selection(record['selection'])
+
+		if command_name != 'soft_undo':
+			undo_stack.append((view._text, [(r.a, r.b) for r in view._sel]))
+
+		if command_name not in window._text_commands:
+			emulate_builtin(view, command_name, args, undo_stack)
+			view._add_history(command_name, args)
+			continue
+
+		sublime.API_CALLS.clear()
+		start_time = time.perf_counter()
+		view.run_command(command_name, args)
+		ms = (time.perf_counter() - start_time) * 1000
+		api_calls = sum(sublime.API_CALLS.values())
+
+		# Anything pushed onto the main/async threads by the command
+		sublime.API_CALLS.clear()
+		start_time = time.perf_counter()
+		sublime.run_deferred()
+		deferred_ms = (time.perf_counter() - start_time) * 1000
+		deferred_api_calls = sum(sublime.API_CALLS.values())
+
+		view._add_history(command_name, args)
+		steps.append(Step(command_name, ms, api_calls, deferred_ms, deferred_api_calls))
+
+	return steps
+
+def best_of(runs):
+	"""Lowest latency of each step across the runs (API calls don't vary)"""
+	steps = runs[0]
+	for run in runs[1:]:
+		for (step, other) in zip(steps, run):
+			step.ms = min(step.ms, other.ms)
+			step.deferred_ms = min(step.deferred_ms, other.deferred_ms)
+	return steps
+
+def print_steps(steps):
+	print('{:>5}  {:<28} {:>10} {:>10} {:>13} {:>13}'.format(
+		'step', 'command', 'ms', 'api calls', 'deferred ms', 'deferred api'))
+	for (i, step) in enumerate(steps):
+		print('{:>5}  {:<28} {:>10.3f} {:>10} {:>13.3f} {:>13}'.format(
+			i, step.command, step.ms, step.api_calls, step.deferred_ms, step.deferred_api_calls))
+	print('{:>5}  {:<28} {:>10.3f} {:>10} {:>13.3f} {:>13}'.format(
+		'', 'total',
+		sum(s.ms for s in steps), sum(s.api_calls for s in steps),
+		sum(s.deferred_ms for s in steps), sum(s.deferred_api_calls for s in steps)))
+
+def compare_to_baseline(steps, baseline, tolerance, slack_ms, check_latency):
+	"""Returns a description of each regression"""
+	baseline_steps = baseline['steps']
+	if [s.command for s in steps] != [s['command'] for s in baseline_steps]:
+		return ['the commands replayed no longer match the baseline']
+
+	regressions = []
+	for (i, (step, expected)) in enumerate(zip(steps, baseline_steps)):
+		for (field, ms) in (('api_calls', False), ('deferred_api_calls', False),
+		                    ('ms', True), ('deferred_ms', True)):
+			if ms and not check_latency:
+				continue
+
+			actual = getattr(step, field)
+			limit = expected[field]
+			if ms:
+				limit = max(limit * tolerance, limit + slack_ms)
+			if actual > limit:
+				regressions.append('step {i} ({command}): {field} {actual} > {expected}'.format(
+					i = i, command = step.command, field = field,
+					actual = round(actual, 3), expected = expected[field]))
+
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('trace')
+	parser.add_argument('--baseline', help='JSON file of the expected results')
+	parser.add_argument('--update-baseline', action='store_true',
+	                    help='write the results to the baseline instead of comparing')
+	parser.add_argument('--repeat', type=int, default=5,
+	                    help='replay this many times and keep the fastest of each step')
+	parser.add_argument('--check-latency', action='store_true',
+	                    help='also fail on steps that are slower than the baseline')
+	parser.add_argument('--tolerance', type=float, default=1.5)
+	parser.add_argument('--slack-ms', type=float, default=1.0)
+	parser.add_argument('--setting', action='append', default=[], metavar='NAME=JSON',
+	                    help='override one of the plugin settings')
+	args = parser.parse_args()
+
+	settings_overrides = {}
+	for setting in args.setting:
+		(name, value) = setting.split('=', 1)
+		settings_overrides[name] = json.loads(value)
+
+	records = read_trace(args.trace)
+	steps = best_of([replay(records, settings_overrides) for i in range(max(args.repeat, 1))])
+	print_steps(steps)
+
+	if not args.baseline:
+		return 0
+
+	if args.update_baseline:
+		with open(args.baseline, 'w', encoding='utf-8') as f:
+			json.dump({'steps': [s.to_json() for s in steps]}, f, indent=1)
+			f.write('\n')
+		print('wrote ' + args.baseline)
+		return 0
+
+	with open(args.baseline, 'r', encoding='utf-8') as f:
+		baseline = json.load(f)
+
+	regressions = compare_to_baseline(steps, baseline, args.tolerance, args.slack_ms,
+	                                  args.check_latency)
+	for regression in regressions:
+		print('REGRESSION: ' + regression)
+
+	return 1 if regressions else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,560 @@
+"""Headless stand-in for the parts of Sublime's `sublime` module that the
+plugin uses, so recorded traces can be replayed outside of the editor
+(see replay.py).
+
+Every call on a View/Window/Selection/Settings is counted in `API_CALLS`,
+since in the real editor each one is a round trip to the plugin host."""
+
+import functools
+import json
+import os
+import re
+import tempfile
+from bisect import bisect_right
+from collections import Counter
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DRAW_EMPTY = 1
+HIDE_ON_MINIMAP = 2
+DRAW_EMPTY_AS_OVERWRITE = 4
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+
+OP_EQUAL = 0
+OP_NOT_EQUAL = 1
+
+API_CALLS = Counter()
+
+# e.g. `len(view.sel())` and `view.sel()[0]` are API calls as well
+COUNTED_DUNDERS = set(['__len__', '__getitem__'])
+
+# Callbacks from set_timeout()/set_timeout_async(), run by run_deferred()
+DEFERRED = []
+
+# Settings that take precedence over the package's defaults
+SETTINGS_OVERRIDES = {}
+
+_windows = []
+_settings = {}
+_next_id = [1]
+_cache_dir = [None]
+
+def api(cls):
+	"""Count every call to the public methods of `cls`"""
+	def counted(name, method):
+		@functools.wraps(method)
+		def wrapper(*args, **kwargs):
+			API_CALLS[cls.__name__ + '.' + name] += 1
+			return method(*args, **kwargs)
+		return wrapper
+
+	for (name, method) in list(vars(cls).items()):
+		if callable(method) and (not name.startswith('_') or name in COUNTED_DUNDERS):
+			setattr(cls, name, counted(name, method))
+	return cls
+
+def _reset():
+	API_CALLS.clear()
+	del DEFERRED[:]
+	del _windows[:]
+	_settings.clear()
+	_next_id[0] = 1
+
+def _new_id():
+	new_id = _next_id[0]
+	_next_id[0] += 1
+	return new_id
+
+def run_deferred(max_callbacks=100000):
+	"""Runs the callbacks queued by set_timeout*(), including any that they
+	   queue themselves. Returns the number of callbacks run."""
+	count = 0
+	while DEFERRED and count < max_callbacks:
+		callback = DEFERRED.pop(0)
+		callback()
+		count += 1
+	return count
+
+def set_timeout(callback, delay=0):
+	DEFERRED.append(callback)
+
+def set_timeout_async(callback, delay=0):
+	DEFERRED.append(callback)
+
+def windows():
+	return list(_windows)
+
+def active_window():
+	return _windows[0] if _windows else None
+
+def packages_path():
+	return os.path.dirname(PACKAGE_DIR)
+
+def cache_path():
+	if _cache_dir[0] is None:
+		_cache_dir[0] = tempfile.mkdtemp(prefix='scoped_quick_select_replay_')
+	return _cache_dir[0]
+
+def _load_json_with_comments(path):
+	with open(path, 'r', encoding='utf-8') as f:
+		text = f.read()
+	# NOTE: Good enough for our own settings files, which don't have
+	# any `//` or trailing commas inside of strings
+	text = re.sub(r'^\s*//.*$', '', text, flags=re.MULTILINE)
+	text = re.sub(r',(\s*[}\]])', r'\1', text)
+	return json.loads(text)
+
+def load_settings(name):
+	if name not in _settings:
+		values = {}
+		path = os.path.join(PACKAGE_DIR, name)
+		if os.path.exists(path):
+			values = _load_json_with_comments(path)
+		values.update(SETTINGS_OVERRIDES)
+		_settings[name] = Settings(values)
+	return _settings[name]
+
+class Region:
+	__slots__ = ['a', 'b', 'xpos']
+
+	def __init__(self, a, b=None, xpos=-1):
+		if b is None:
+			b = a
+		self.a = a
+		self.b = b
+		self.xpos = xpos
+
+	def __str__(self):
+		return '(' + str(self.a) + ', ' + str(self.b) + ')'
+
+	def __repr__(self):
+		return '(' + str(self.a) + ', ' + str(self.b) + ')'
+
+	def __len__(self):
+		return self.size()
+
+	def __eq__(self, rhs):
+		return isinstance(rhs, Region) and self.a == rhs.a and self.b == rhs.b
+
+	def __hash__(self):
+		return hash((self.a, self.b))
+
+	def __lt__(self, rhs):
+		lhb = self.begin()
+		rhb = rhs.begin()
+		if lhb == rhb:
+			return self.end() < rhs.end()
+		return lhb < rhb
+
+	def empty(self):
+		return self.a == self.b
+
+	def begin(self):
+		return min(self.a, self.b)
+
+	def end(self):
+		return max(self.a, self.b)
+
+	def size(self):
+		return abs(self.a - self.b)
+
+	def contains(self, x):
+		if isinstance(x, Region):
+			return self.contains(x.a) and self.contains(x.b)
+		return x >= self.begin() and x <= self.end()
+
+	def cover(self, rhs):
+		return Region(min(self.begin(), rhs.begin()), max(self.end(), rhs.end()))
+
+	def intersection(self, rhs):
+		if self.end() <= rhs.begin():
+			return Region(0)
+		if self.begin() >= rhs.end():
+			return Region(0)
+		return Region(max(self.begin(), rhs.begin()), min(self.end(), rhs.end()))
+
+	def intersects(self, rhs):
+		lb = self.begin()
+		le = self.end()
+		rb = rhs.begin()
+		re_ = rhs.end()
+		return ((lb == rb and le == re_) or
+		        (rb > lb and rb < le) or (re_ > lb and re_ < le) or
+		        (lb > rb and lb < re_) or (le > rb and le < re_))
+
+@api
+class Settings:
+	def __init__(self, values=None):
+		self._values = dict(values or {})
+		# tag -> list of callbacks
+		self._on_change = {}
+
+	def _changed(self):
+		for callbacks in list(self._on_change.values()):
+			for callback in callbacks:
+				callback()
+
+	def get(self, key, default=None):
+		return self._values.get(key, default)
+
+	def has(self, key):
+		return key in self._values
+
+	def set(self, key, value):
+		self._values[key] = value
+		self._changed()
+
+	def erase(self, key):
+		self._values.pop(key, None)
+		self._changed()
+
+	def add_on_change(self, tag, callback):
+		self._on_change.setdefault(tag, []).append(callback)
+
+	def clear_on_change(self, tag):
+		self._on_change.pop(tag, None)
+
+@api
+class Selection:
+	def __init__(self, view):
+		self._view = view
+		self._regions = []
+
+	def __len__(self):
+		return len(self._regions)
+
+	def __getitem__(self, index):
+		return self._regions[index]
+
+	def __iter__(self):
+		return iter(list(self._regions))
+
+	def _normalize(self):
+		merged = []
+		for region in sorted(self._regions):
+			if merged and (region.begin() < merged[-1].end() or region == merged[-1]):
+				previous = merged[-1]
+				if region.end() > previous.end():
+					merged[-1] = Region(previous.begin(), region.end())
+				continue
+			merged.append(region)
+		self._regions = merged
+
+	def clear(self):
+		self._regions = []
+
+	def add(self, region):
+		self._regions.append(region)
+		self._normalize()
+
+	def add_all(self, regions):
+		for region in regions:
+			self._regions.append(region)
+		self._normalize()
+
+	def subtract(self, region):
+		remaining = []
+		for r in self._regions:
+			if r.end() <= region.begin() or r.begin() >= region.end():
+				if r != region:
+					remaining.append(r)
+				continue
+			if r.begin() < region.begin():
+				remaining.append(Region(r.begin(), region.begin()))
+			if r.end() > region.end():
+				remaining.append(Region(region.end(), r.end()))
+		self._regions = remaining
+
+	def contains(self, region):
+		return any(r.contains(region) for r in self._regions)
+
+class Edit:
+	def __init__(self, token):
+		self.edit_token = token
+
+@api
+class View:
+	def __init__(self, window, text='', name=''):
+		self._id = _new_id()
+		self._window = window
+		self._text = text
+		self._change_count = 0
+		self._saved_change_count = 0
+		self._line_starts = None
+		self._sel = Selection(self)
+		self._sel.add(Region(0))
+		self._regions = {}
+		self._status = {}
+		self._settings = Settings({'syntax': 'Packages/Text/Plain text.tmLanguage'})
+		self._file_name = None
+		self._name = name
+		self._scratch = False
+		# (command name, args, repeat count), oldest first
+		self._history = []
+
+	# Replayer hooks (not part of Sublime's API)
+
+	def _set_text(self, text):
+		if text != self._text:
+			self._text = text
+			self._change_count += 1
+			self._line_starts = None
+
+	def _mark_saved(self):
+		self._saved_change_count = self._change_count
+
+	def _set_selection(self, regions):
+		self._sel.clear()
+		self._sel.add_all(Region(a, b) for (a, b) in regions)
+
+	def _add_history(self, command_name, args):
+		self._history.append((command_name, args, 1))
+
+	# Sublime's API
+
+	def id(self):
+		return self._id
+
+	def buffer_id(self):
+		return self._id
+
+	def window(self):
+		return self._window
+
+	def file_name(self):
+		return self._file_name
+
+	def name(self):
+		return self._name
+
+	def settings(self):
+		return self._settings
+
+	def is_dirty(self):
+		return self._change_count != self._saved_change_count
+
+	def is_scratch(self):
+		return self._scratch
+
+	def set_scratch(self, scratch):
+		self._scratch = scratch
+
+	def close(self):
+		if self in self._window._views:
+			self._window._views.remove(self)
+
+	def change_count(self):
+		return self._change_count
+
+	def size(self):
+		return len(self._text)
+
+	def substr(self, x):
+		if isinstance(x, Region):
+			return self._text[x.begin():x.end()]
+		return self._text[x:x + 1]
+
+	def sel(self):
+		return self._sel
+
+	def begin_edit(self, edit_token, command_name, args=None):
+		return Edit(edit_token)
+
+	def end_edit(self, edit):
+		pass
+
+	def insert(self, edit, point, text):
+		self._set_text(self._text[:point] + text + self._text[point:])
+		return len(text)
+
+	def erase(self, edit, region):
+		self._set_text(self._text[:region.begin()] + self._text[region.end():])
+
+	def replace(self, edit, region, text):
+		self._set_text(self._text[:region.begin()] + text + self._text[region.end():])
+
+	def find(self, pattern, start_point, flags=0):
+		match = re.compile(pattern).search(self._text, start_point)
+		if match is None:
+			return Region(-1, -1)
+		return Region(match.start(), match.end())
+
+	def find_all(self, pattern, flags=0):
+		return [Region(m.start(), m.end()) for m in re.finditer(pattern, self._text)]
+
+	def find_by_selector(self, selector):
+		# NOTE: No syntax highlighting here, so no scopes either
+		return []
+
+	def scope_name(self, point):
+		return 'text.plain '
+
+	def match_selector(self, point, selector):
+		return False
+
+	def symbols(self):
+		return []
+
+	def _get_line_starts(self):
+		if self._line_starts is None:
+			self._line_starts = [0] + [m.end() for m in re.finditer('\n', self._text)]
+		return self._line_starts
+
+	def rowcol(self, point):
+		line_starts = self._get_line_starts()
+		row = bisect_right(line_starts, point) - 1
+		return (row, point - line_starts[row])
+
+	def line(self, x):
+		point = x.begin() if isinstance(x, Region) else x
+		begin = self._text.rfind('\n', 0, point) + 1
+		end = self._text.find('\n', point)
+		if end < 0:
+			end = len(self._text)
+		return Region(begin, end)
+
+	def word(self, x):
+		point = x.begin() if isinstance(x, Region) else x
+		begin = point
+		end = x.end() if isinstance(x, Region) else point
+		while begin > 0 and (self._text[begin - 1].isalnum() or self._text[begin - 1] == '_'):
+			begin -= 1
+		while end < len(self._text) and (self._text[end].isalnum() or self._text[end] == '_'):
+			end += 1
+		return Region(begin, end)
+
+	def add_regions(self, key, regions, scope='', icon='', flags=0):
+		self._regions[key] = list(regions)
+
+	def get_regions(self, key):
+		return list(self._regions.get(key, []))
+
+	def erase_regions(self, key):
+		self._regions.pop(key, None)
+
+	def set_status(self, key, value):
+		self._status[key] = value
+
+	def get_status(self, key):
+		return self._status.get(key, '')
+
+	def erase_status(self, key):
+		self._status.pop(key, None)
+
+	def command_history(self, index, modifying_only=False):
+		# NOTE: 0 is the most recent command, negative goes further back,
+		# there's never anything to redo
+		position = len(self._history) - 1 + index
+		if index > 0 or position < 0:
+			return ('', None, 0)
+		return self._history[position]
+
+	def visible_region(self):
+		return Region(0, len(self._text))
+
+	def viewport_position(self):
+		return (0.0, 0.0)
+
+	def viewport_extent(self):
+		return (800.0, 600.0)
+
+	def set_viewport_position(self, xy, animate=True):
+		pass
+
+	def show(self, x, show_surrounds=True):
+		pass
+
+	def show_at_center(self, x):
+		pass
+
+	def run_command(self, command_name, args=None):
+		self._window._run_text_command(self, command_name, args or {})
+
+@api
+class Window:
+	def __init__(self):
+		self._id = _new_id()
+		self._views = []
+		self._status_messages = []
+		# command name -> class, filled in by the replayer
+		self._text_commands = {}
+		self._window_commands = {}
+		_windows.append(self)
+
+	def _run_text_command(self, view, command_name, args):
+		command_class = self._text_commands.get(command_name)
+		if command_class is not None:
+			command = command_class(view)
+			edit = view.begin_edit(_new_id(), command_name, args)
+			try:
+				command.run(edit, **args)
+			finally:
+				view.end_edit(edit)
+
+	def id(self):
+		return self._id
+
+	def new_file(self):
+		view = View(self)
+		self._views.append(view)
+		return view
+
+	def views(self):
+		return list(self._views)
+
+	def active_view(self):
+		return self._views[0] if self._views else None
+
+	def focus_view(self, view):
+		pass
+
+	def focus_sheet(self, sheet):
+		pass
+
+	def folders(self):
+		return []
+
+	def project_data(self):
+		return None
+
+	def status_message(self, message):
+		self._status_messages.append(message)
+
+	def get_layout(self):
+		return {'cols': [0.0, 1.0], 'rows': [0.0, 1.0], 'cells': [[0, 0, 1, 1]]}
+
+	def set_layout(self, layout):
+		pass
+
+	def active_group(self):
+		return 0
+
+	def num_groups(self):
+		return 1
+
+	def active_sheet_in_group(self, group):
+		return None
+
+	def sheets(self):
+		return []
+
+	def get_sheet_index(self, sheet):
+		return (0, 0)
+
+	def set_sheet_index(self, sheet, group, index):
+		pass
+
+	def get_tabs_visible(self):
+		return False
+
+	def set_tabs_visible(self, visible):
+		pass
+
+	def create_output_panel(self, name):
+		return View(self, name=name)
+
+	def run_command(self, command_name, args=None):
+		command_class = self._window_commands.get(command_name)
+		if command_class is not None:
+			command_class(self).run(**(args or {}))
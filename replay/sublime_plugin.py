@@ -0,0 +1,43 @@
+"""Headless stand-in for Sublime's `sublime_plugin` module (see replay.py)"""
+
+class Command:
+	def name(self):
+		# NOTE: Same as Sublime, e.g. `SetQuickSelectScope` -> `set_quick_select_scope`
+		clsname = self.__class__.__name__
+		name = clsname[0].lower()
+		last_upper = False
+		for c in clsname[1:]:
+			if c.isupper() and not last_upper:
+				name += '_'
+				name += c.lower()
+			else:
+				name += c
+			last_upper = c.isupper()
+		if name.endswith('_command'):
+			name = name[0:-8]
+		return name
+
+class TextCommand(Command):
+	def __init__(self, view):
+		self.view = view
+
+class WindowCommand(Command):
+	def __init__(self, window):
+		self.window = window
+
+class EventListener:
+	pass
+
+class ViewEventListener:
+	def __init__(self, view):
+		self.view = view
+
+	@classmethod
+	def is_applicable(cls, settings):
+		return True
+
+class TextInputHandler:
+	pass
+
+def check_view_event_listeners(view):
+	pass